@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+"""Benchmark carriersettings_extractor on synthetic CarrierSettings corpora.
+
+The real inputs are proprietary vendor blobs, so this generates a CarrierSettings
+directory and a carrier_id database of configurable size, measures the time and
+memory of the stages of an extraction separately and stores the results as JSON.
+Comparing against the JSON of a previous run reports the stages which got slower
+or use more memory.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os.path
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import product
+
+import carriersettings_extractor as cse
+
+config_types = ["text", "int", "long", "bool", "text_array", "int_array"]
+
+
+def add_configs(rnd, carrier_config, count, depth, unwanted_keys):
+    for i in range(count):
+        config = carrier_config.config.add()
+        if depth > 0 and i == 0:
+            config.key = f"bundle_{depth}_config"
+            add_configs(
+                rnd, config.bundle, max(count // 4, 1), depth - 1, unwanted_keys
+            )
+            continue
+        value_type = rnd.choice(config_types)
+        if rnd.random() < 0.05:
+            config.key = rnd.choice(unwanted_keys)
+        else:
+            config.key = f"config_{i}_{value_type}"
+        match value_type:
+            case "text":
+                config.text_value = f"value {rnd.randrange(1000)}"
+            case "int":
+                config.int_value = rnd.randrange(-100, 100)
+            case "long":
+                config.long_value = rnd.randrange(2**40)
+            case "bool":
+                config.bool_value = rnd.random() < 0.5
+            case "text_array":
+                config.text_array.item.extend(
+                    f"item {j}" for j in range(rnd.randrange(1, 5))
+                )
+            case "int_array":
+                config.int_array.item.extend(
+                    rnd.randrange(100) for _ in range(rnd.randrange(1, 5))
+                )
+
+
+def add_apns(rnd, carrier_settings, count):
+    for i in range(count):
+        apn = carrier_settings.apns.apn.add()
+        apn.name = f"APN {i}"
+        apn.value = f"apn{i}.example.com"
+        apn.type.extend(rnd.sample(range(1, 8), rnd.randrange(1, 4)))
+        if rnd.random() < 0.5:
+            apn.mmsc = "http://mms.example.com"
+            apn.mmsc_proxy = "10.0.0.1"
+            apn.mmsc_proxy_port = "8080"
+        apn.authtype = rnd.randrange(4)
+        apn.protocol = rnd.randrange(3)
+        apn.roaming_protocol = rnd.randrange(3)
+        apn.user_visible = rnd.random() < 0.5
+        apn.skip_464xlat = rnd.randrange(3)
+
+
+def generate_corpus(
+    directory,
+    carriers=1000,
+    apns=3,
+    configs=40,
+    bundle_depth=1,
+    carrier_files=0.1,
+    seed=0,
+    other_carrier_ids=0,
+):
+    """Write a synthetic CarrierSettings directory and AOSP carrier_id database.
+
+    The database also lists other_carrier_ids carriers which are not in the
+    CarrierSettings directory, with several values per attribute field like
+    the AOSP one, on MCCs none of the CarrierSettings carriers use.
+
+    Returns the CarrierSettings directory and the root of the fake AOSP tree.
+    """
+    from carrier_list_pb2 import CarrierList
+    from carrier_settings_pb2 import CarrierSettings, MultiCarrierSettings
+    from carrierId_pb2 import CarrierList as CarrierIdList
+
+    rnd = random.Random(seed)
+    pb_path = os.path.join(directory, "CarrierSettings")
+    android_build_top = os.path.join(directory, "aosp")
+    carrier_id_path = os.path.join(android_build_top, cse.android_path_to_carrierid)
+    os.makedirs(pb_path, exist_ok=True)
+    os.makedirs(carrier_id_path, exist_ok=True)
+    unwanted_keys = [rule for _, rule in cse.load_config_rules()]
+
+    carrier_list = CarrierList()
+    carrier_id_list = CarrierIdList()
+    multi_settings = MultiCarrierSettings()
+    mccmncs = [f"{rnd.randrange(200, 800)}{rnd.randrange(100):02}" for _ in range(200)]
+    for i in range(carriers):
+        canonical_name = f"carrier{i}"
+        entry = carrier_list.entry.add()
+        entry.canonical_name = canonical_name
+        carrier_id = entry.carrier_id.add()
+        carrier_id.mcc_mnc = rnd.choice(mccmncs)
+        # About a third of the carriers are MVNOs
+        match rnd.randrange(6):
+            case 0:
+                carrier_id.spn = f"MVNO {i}"
+            case 1:
+                carrier_id.gid1 = f"{i:04X}"
+
+        carrier_id_obj = carrier_id_list.carrier_id.add()
+        carrier_id_obj.canonical_id = 1000 + i
+        carrier_attribute = carrier_id_obj.carrier_attribute.add()
+        carrier_attribute.mccmnc_tuple.append(carrier_id.mcc_mnc)
+        if carrier_id.HasField("spn"):
+            carrier_attribute.spn.append(carrier_id.spn)
+        if carrier_id.HasField("gid1"):
+            carrier_attribute.gid1.append(carrier_id.gid1)
+
+        carrier_settings = CarrierSettings()
+        carrier_settings.canonical_name = canonical_name
+        add_apns(rnd, carrier_settings, apns)
+        add_configs(rnd, carrier_settings.configs, configs, bundle_depth, unwanted_keys)
+        if rnd.random() < carrier_files:
+            with open(os.path.join(pb_path, canonical_name + ".pb"), "wb") as pb:
+                pb.write(carrier_settings.SerializeToString())
+        else:
+            multi_settings.setting.append(carrier_settings)
+
+    # A separate generator, so the carriers above do not depend on this
+    rnd = random.Random(f"carrier_id {seed}")
+    for i in range(other_carrier_ids):
+        carrier_id_obj = carrier_id_list.carrier_id.add()
+        carrier_id_obj.canonical_id = 1000 + carriers + i
+        for _ in range(rnd.randrange(1, 4)):
+            carrier_attribute = carrier_id_obj.carrier_attribute.add()
+            carrier_attribute.mccmnc_tuple.extend(
+                f"{rnd.randrange(900, 1000)}{rnd.randrange(100):02}"
+                for _ in range(rnd.randrange(1, 7))
+            )
+            carrier_attribute.spn.extend(
+                f"Other {i} {j}" for j in range(rnd.choice([0, 0, 1, 2, 4]))
+            )
+            carrier_attribute.gid1.extend(
+                f"{rnd.randrange(0x10000):04X}" for _ in range(rnd.choice([0, 0, 1, 3]))
+            )
+            if rnd.random() < 0.2:
+                carrier_attribute.imsi_prefix_xpattern.append(
+                    f"{carrier_attribute.mccmnc_tuple[0]}{rnd.randrange(10)}x"
+                )
+            if rnd.random() < 0.1:
+                carrier_attribute.iccid_prefix.extend(
+                    f"89{rnd.randrange(10000):04}" for _ in range(rnd.randrange(1, 4))
+                )
+            if rnd.random() < 0.05:
+                carrier_attribute.privilege_access_rule.append(f"{i:040X}")
+
+    with open(os.path.join(pb_path, "carrier_list.pb"), "wb") as pb:
+        pb.write(carrier_list.SerializeToString())
+    with open(os.path.join(pb_path, "others.pb"), "wb") as pb:
+        pb.write(multi_settings.SerializeToString())
+    with open(os.path.join(carrier_id_path, "carrier_list.pb"), "wb") as pb:
+        pb.write(carrier_id_list.SerializeToString())
+    return pb_path, android_build_top
+
+
+def build_carrier_attribute_map(carrier_id_list):
+    """Build the map of carrier_id attributes carriersettings_extractor used
+    before CarrierIdMatcher, expanding each into the product of its fields."""
+    carrier_attribute_map = {}
+    for carrier_id_obj in carrier_id_list.carrier_id:
+        for carrier_attribute in carrier_id_obj.carrier_attribute:
+            for carrier_attributes in product(
+                *(
+                    [s.lower() for s in getattr(carrier_attribute, i) or [""]]
+                    for i in [
+                        "mccmnc_tuple",
+                        "imsi_prefix_xpattern",
+                        "spn",
+                        "plmn",
+                        "gid1",
+                        "preferred_apn",
+                        "iccid_prefix",
+                        "privilege_access_rule",
+                    ]
+                )
+            ):
+                carrier_attribute_map[carrier_attributes] = carrier_id_obj.canonical_id
+    return carrier_attribute_map
+
+
+def carrier_id_probes(carrier_id_list):
+    """Yield every carrier_list CarrierId an attribute of a carrier_id database
+    can match: its mccmnc alone, or with one of its IMSI prefixes, SPNs or
+    GID1s."""
+    from carrier_list_pb2 import CarrierId
+
+    for carrier_id_obj in carrier_id_list.carrier_id:
+        for carrier_attribute in carrier_id_obj.carrier_attribute:
+            for mcc_mnc in carrier_attribute.mccmnc_tuple:
+                yield CarrierId(mcc_mnc=mcc_mnc)
+                for field, attribute_field in [
+                    ("imsi", "imsi_prefix_xpattern"),
+                    ("spn", "spn"),
+                    ("gid1", "gid1"),
+                ]:
+                    for value in getattr(carrier_attribute, attribute_field):
+                        yield CarrierId(mcc_mnc=mcc_mnc, **{field: value})
+
+
+def compare_carrier_id_map(carrier_id_matcher, carrier_list=None):
+    """Compare the CarrierIdMatcher index with the former carrier_attribute_map.
+
+    Both resolve the CarrierIds of carrier_list, if given, and every one the
+    database can match, see carrier_id_probes(). Returns their number of keys
+    and tracemalloc peak in KiB, the number of CarrierIds resolved and those
+    resolved differently.
+    """
+    import tracemalloc
+
+    results = {}
+    tracemalloc.start()
+    try:
+        carrier_attribute_map = build_carrier_attribute_map(
+            carrier_id_matcher.carrier_id_list
+        )
+        results["map_peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.reset_peak()
+        results["index_peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        carrier_id_matcher.index
+        results["index_peak_kib"] = (
+            tracemalloc.get_traced_memory()[1] // 1024 - results["index_peak_kib"]
+        )
+    finally:
+        tracemalloc.stop()
+    results["map_keys"] = len(carrier_attribute_map)
+    results["index_keys"] = len(carrier_id_matcher.index)
+
+    carrier_ids = list(carrier_id_probes(carrier_id_matcher.carrier_id_list))
+    if carrier_list is not None:
+        carrier_ids += [entry.carrier_id[0] for entry in carrier_list.entry]
+    differences = []
+    for carrier_id in carrier_ids:
+        expected = carrier_attribute_map.get(
+            (
+                carrier_id.mcc_mnc,
+                carrier_id.imsi,
+                carrier_id.spn.lower(),
+                "",
+                carrier_id.gid1.lower(),
+                "",
+                "",
+                "",
+            )
+        )
+        actual = carrier_id_matcher.lookup(carrier_id)
+        if actual != expected:
+            differences.append(
+                {
+                    "carrier_id": {
+                        field.name: value for field, value in carrier_id.ListFields()
+                    },
+                    "map": expected,
+                    "index": actual,
+                }
+            )
+    results["carrier_ids"] = len(carrier_ids)
+    results["differences"] = differences
+    return results
+
+
+def peak_rss_kib():
+    """Return the peak resident set size of this process in KiB.
+
+    ru_maxrss carries over the peak of the process this one was forked from,
+    VmHWM only counts this one, so it is preferred where there is one.
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return cse.peak_rss_kib()
+
+
+def run_stages(pb_path, android_build_top, device, jobs):
+    """Time one extraction, returning the wall time in seconds and the growth of
+    the peak RSS in KiB of each stage, and the peak RSS of the extraction.
+
+    The RSS only reflects the extraction in a fresh process, see measure().
+    Processes rendering with jobs > 1 are not included.
+    """
+    times = {}
+    rss = {}
+
+    @contextmanager
+    def stage(name):
+        peak_rss = peak_rss_kib()
+        start = time.perf_counter()
+        yield
+        times[name] = time.perf_counter() - start
+        rss[name] = peak_rss_kib() - peak_rss
+
+    with stage("carrier_id_map"):
+        carrier_id_matcher = cse.load_carrier_ids(android_build_top)
+        carrier_id_matcher.index
+
+    with stage("load"):
+        carrier_list, all_settings = cse.load_settings(pb_path)
+
+    with stage("apn_render"):
+        cse.render_apns(io.StringIO(), carrier_list, all_settings, carrier_id_matcher)
+
+    with stage("carrier_config_render"):
+        cse.render_carrier_configs(
+            io.StringIO(), carrier_list, all_settings, device, jobs=jobs
+        )
+    peak_rss = peak_rss_kib()
+
+    # The carrier_id_map stage with the map CarrierIdMatcher replaced, last so
+    # its memory does not hide the growth of the stages above
+    cse._loaded.clear()
+    with stage("carrier_attribute_map"):
+        build_carrier_attribute_map(
+            cse.load_carrier_ids(android_build_top).carrier_id_list
+        )
+    return times, rss, peak_rss
+
+
+def measure(pb_path, android_build_top, device, jobs):
+    """Run run_stages() in a fresh process, so neither inputs parsed nor memory
+    used before skew it."""
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(
+            run_stages, pb_path, android_build_top, device, jobs
+        ).result()
+
+
+def compare(results, baseline, threshold):
+    """Print stages which got slower, or whose peak RSS grew more, than
+    threshold times the baseline."""
+    regressions = 0
+    for stage, seconds in results["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if not previous:
+            continue
+        ratio = seconds / previous
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{stage:24} {previous:9.4f}s -> {seconds:9.4f}s  x{ratio:.2f}{flag}")
+    rss = dict(results["rss_kib"], peak=results["peak_rss_kib"])
+    previous_rss = dict(baseline.get("rss_kib", {}), peak=baseline.get("peak_rss_kib"))
+    for stage, kib in rss.items():
+        previous = previous_rss.get(stage)
+        if previous is None:
+            continue
+        flag = ""
+        # Less than 1 MiB more is noise, whatever the baseline
+        if kib > max(previous * threshold, previous + 1024):
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{stage:24} {previous:8}KiB -> {kib:8}KiB{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--carriers", type=int, default=1000)
+    parser.add_argument("--apns", type=int, default=3, help="APNs per carrier")
+    parser.add_argument("--configs", type=int, default=40, help="configs per carrier")
+    parser.add_argument(
+        "--bundle-depth", type=int, default=1, help="nesting of bundle configs"
+    )
+    parser.add_argument(
+        "--carrier-files",
+        type=float,
+        default=0.1,
+        help="share of carriers in their own file instead of others.pb",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--other-carrier-ids",
+        type=int,
+        default=1000,
+        help="carrier_id database carriers missing from CarrierSettings",
+    )
+    parser.add_argument(
+        "--carrier-id",
+        metavar="FILE",
+        help="carrier_list.pb of a carrier_id database, like the AOSP one, to compare"
+        " the carrier_id index with the former map on instead of the generated one",
+    )
+    parser.add_argument("--device", default="oriole")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of N")
+    parser.add_argument("--corpus", help="keep the generated corpus in this directory")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.1,
+        help="slowdown or peak RSS growth reported as a regression (default: 1.1)",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = args.corpus or directory
+        pb_path, android_build_top = generate_corpus(
+            corpus,
+            args.carriers,
+            args.apns,
+            args.configs,
+            args.bundle_depth,
+            args.carrier_files,
+            args.seed,
+            args.other_carrier_ids,
+        )
+        if args.carrier_id:
+            carrier_id_map = compare_carrier_id_map(
+                cse.CarrierIdMatcher(filename=args.carrier_id)
+            )
+        else:
+            carrier_id_map = compare_carrier_id_map(
+                cse.load_carrier_ids(android_build_top), cse.load_settings(pb_path)[0]
+            )
+            cse._loaded.clear()
+        stages = {}
+        rss = {}
+        peak_rss = None
+        for _ in range(args.repeat):
+            times, stage_rss, run_peak_rss = measure(
+                pb_path, android_build_top, args.device, args.jobs
+            )
+            for stage, seconds in times.items():
+                stages[stage] = min(seconds, stages.get(stage, seconds))
+            for stage, kib in stage_rss.items():
+                rss[stage] = min(kib, rss.get(stage, kib))
+            peak_rss = min(run_peak_rss, peak_rss or run_peak_rss)
+
+    results = {
+        "parameters": {
+            "carriers": args.carriers,
+            "apns": args.apns,
+            "configs": args.configs,
+            "bundle_depth": args.bundle_depth,
+            "carrier_files": args.carrier_files,
+            "seed": args.seed,
+            "other_carrier_ids": args.other_carrier_ids,
+            "device": args.device,
+            "jobs": args.jobs,
+        },
+        "python": platform.python_version(),
+        "stages": stages,
+        "carrier_id_map": dict(carrier_id_map, database=args.carrier_id),
+        "rss_kib": rss,
+        "peak_rss_kib": peak_rss,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    for difference in carrier_id_map["differences"]:
+        print(
+            f"carrier_id {difference['carrier_id']}: map {difference['map']},"
+            f" index {difference['index']}",
+            file=sys.stderr,
+        )
+    if carrier_id_map["differences"]:
+        sys.exit(1)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != results["parameters"]:
+            print("Warning: comparing runs with different parameters", file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,1072 @@
 #!/usr/bin/env python3
 
-from collections import OrderedDict
+import argparse
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext, redirect_stderr, redirect_stdout
+from functools import partial
 from glob import glob
-from itertools import product
+import hashlib
+import io
+import json
+import mmap
 import os.path
+import posixpath
+import re
+import shlex
+import shutil
+import struct
 import sys
-from xml.etree import ElementTree as ET
+import threading
+import time
+import traceback
+from xml.parsers import expat
 from xml.sax.saxutils import escape, quoteattr
 
-from carrier_settings_pb2 import CarrierSettings, MultiCarrierSettings
-from carrier_list_pb2 import CarrierList
-from carrierId_pb2 import CarrierList as CarrierIdList
+# The generated protobuf modules and the executors are imported where they are
+# used, so that importing this module does no more than define its functions.
 
-pb_path = sys.argv[1]
+android_path_to_carrierid = (
+    "packages/providers/TelephonyProvider/assets/latest_carrier_id"
+)
 
-android_build_top = sys.argv[2]
 
-apn_out = sys.argv[3]
+class Stats:
+    """Wall and CPU time spent per stage, and counters, of this process."""
 
-cc_out = sys.argv[4]
+    def __init__(self):
+        self.reset()
 
-device = sys.argv[5]
+    def reset(self):
+        self.stages = {}
+        self.counts = Counter()
+        self.workers_peak_rss_kib = 0
 
-android_path_to_carrierid = (
-    "packages/providers/TelephonyProvider/assets/latest_carrier_id"
-)
-carrier_id_list = CarrierIdList()
-carrier_attribute_map = {}
-with open(
-    os.path.join(android_build_top, android_path_to_carrierid, "carrier_list.pb"), "rb"
-) as pb:
-    carrier_id_list.ParseFromString(pb.read())
-for carrier_id_obj in carrier_id_list.carrier_id:
-    for carrier_attribute in carrier_id_obj.carrier_attribute:
-        for carrier_attributes in product(
-            *(
-                (s.lower() for s in getattr(carrier_attribute, i) or [""])
-                for i in [
-                    "mccmnc_tuple",
-                    "imsi_prefix_xpattern",
-                    "spn",
-                    "plmn",
-                    "gid1",
-                    "preferred_apn",
-                    "iccid_prefix",
-                    "privilege_access_rule",
-                ]
-            )
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"wall": 0, "cpu": 0, "calls": 0})
+            stage["wall"] += time.perf_counter() - wall
+            stage["cpu"] += time.process_time() - cpu
+            stage["calls"] += 1
+
+    def merge(self, other):
+        """Add the stages and counts of another Stats.as_dict()."""
+        for name, other_stage in other["stages"].items():
+            stage = self.stages.setdefault(name, {"wall": 0, "cpu": 0, "calls": 0})
+            for key, value in other_stage.items():
+                stage[key] += value
+        self.counts.update(other["counts"])
+        self.workers_peak_rss_kib = max(
+            self.workers_peak_rss_kib, other["peak_rss_kib"]
+        )
+
+    def as_dict(self):
+        result = {
+            "stages": self.stages,
+            "counts": dict(self.counts),
+            "peak_rss_kib": peak_rss_kib(),
+        }
+        if self.workers_peak_rss_kib:
+            result["workers_peak_rss_kib"] = self.workers_peak_rss_kib
+        return result
+
+
+def peak_rss_kib():
+    """Return the peak resident set size of this process."""
+    import resource
+
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+    return peak_rss
+
+
+# Instrumentation of the extraction, reported by --stats-json
+stats = Stats()
+
+
+class CarrierIdMatcher:
+    """Resolve carrier_list CarrierId entries to carrier_id canonical ids.
+
+    Attributes are indexed by mccmnc tuple, so a lookup only filters the few
+    candidates sharing its mccmnc instead of expanding every attribute into the
+    product of all its fields.  The index is built on first use.
+
+    A matcher of the database in a file only parses it on first use too, so
+    that extractions reading the resolved ids from a snapshot never do.
+    """
+
+    # Fields the CarrierSettings CarrierId cannot express; attributes which set
+    # any of them never match an entry of carrier_list.pb.
+    unmatched_fields = [
+        "plmn",
+        "preferred_apn",
+        "iccid_prefix",
+        "privilege_access_rule",
+    ]
+
+    def __init__(self, carrier_id_list=None, digest=None, filename=None):
+        """Match against carrier_id_list, or the database in filename."""
+        self._carrier_id_list = carrier_id_list
+        self._digest = digest
+        self.filename = filename
+        # Path, mtime and size of filename, identifies the database without
+        # reading it
+        self.signature = None
+        if filename is not None:
+            st = os.stat(filename)
+            self.signature = (filename, st.st_mtime_ns, st.st_size)
+        self._index = None
+
+    def _load(self):
+        from carrierId_pb2 import CarrierList as CarrierIdList
+
+        carrier_id_list = CarrierIdList()
+        with stats.stage("load_carrier_ids"), mapped_file(self.filename) as data:
+            carrier_id_list.ParseFromString(data)
+            self._digest = hashlib.sha256(data).hexdigest()
+        self._carrier_id_list = carrier_id_list
+
+    @property
+    def carrier_id_list(self):
+        if self._carrier_id_list is None:
+            self._load()
+        return self._carrier_id_list
+
+    @property
+    def digest(self):
+        """Hash of the serialized database, identifies it in caches."""
+        if self._digest is None and self.filename is not None:
+            self._load()
+        return self._digest
+
+    def _build_index(self):
+        index = {}
+        for carrier_id_obj in self.carrier_id_list.carrier_id:
+            for carrier_attribute in carrier_id_obj.carrier_attribute:
+                if any(
+                    getattr(carrier_attribute, i)
+                    and "" not in getattr(carrier_attribute, i)
+                    for i in self.unmatched_fields
+                ):
+                    continue
+                values = {}
+                for field in ["mccmnc_tuple", "imsi_prefix_xpattern", "spn", "gid1"]:
+                    values[field] = frozenset(
+                        s.lower() for s in getattr(carrier_attribute, field) or [""]
+                    )
+                candidate = (
+                    values["imsi_prefix_xpattern"],
+                    values["spn"],
+                    values["gid1"],
+                    carrier_attribute,
+                    carrier_id_obj.canonical_id,
+                )
+                for mccmnc in values["mccmnc_tuple"]:
+                    index.setdefault(mccmnc, []).append(candidate)
+        # Later attributes take precedence over earlier ones
+        for candidates in index.values():
+            candidates.reverse()
+        return index
+
+    def __getstate__(self):
+        # The index is cheap to rebuild and refers into carrier_id_list
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            with stats.stage("carrier_id_index"):
+                self._index = self._build_index()
+        return self._index
+
+    def lookup(self, carrier_id):
+        """Return the canonical id whose attribute lists exactly the mccmnc and
+        MVNO data of a carrier_list CarrierId, or None."""
+        spn = carrier_id.spn.lower()
+        gid1 = carrier_id.gid1.lower()
+        for imsis, spns, gid1s, _, canonical_id in self.index.get(
+            carrier_id.mcc_mnc, ()
         ):
-            carrier_attribute_map[carrier_attributes] = carrier_id_obj.canonical_id
+            if carrier_id.imsi in imsis and spn in spns and gid1 in gid1s:
+                return canonical_id
+        return None
 
-carrier_list = CarrierList()
-all_settings = {}
-carrier_list.ParseFromString(
-    open(os.path.join(pb_path, "carrier_list.pb"), "rb").read()
-)
-# Load generic settings first
-multi_settings = MultiCarrierSettings()
-multi_settings.ParseFromString(open(os.path.join(pb_path, "others.pb"), "rb").read())
-for setting in multi_settings.setting:
-    all_settings[setting.canonical_name] = setting
-# Load carrier specific files last, to allow overriding generic settings
-for filename in glob(os.path.join(pb_path, "*.pb")):
-    with open(filename, "rb") as pb:
-        if os.path.basename(filename) == "carrier_list.pb":
-            # Handled above already
-            continue
-        elif os.path.basename(filename) == "others.pb":
-            # Handled above already
-            continue
+    # Scores CarrierResolver gives the fields of an attribute matching a SIM,
+    # mccmnc is left out as every candidate of an mccmnc has it
+    imsi_prefix_score = 1 << 7
+    gid1_score = 1 << 5
+    spn_score = 1 << 1
+
+    def match(self, mcc_mnc, imsi="", spn="", gid1=""):
+        """Return the canonical id CarrierResolver gives a SIM, or None.
+
+        IMSI prefixes match with "x" as a wildcard digit, GID1 values match by
+        case-insensitive prefix and SPNs case-insensitively. Every field an
+        attribute sets must match, and the attribute whose matching fields
+        score highest wins, an IMSI prefix outweighing a GID1 outweighing an
+        SPN. On a tie, the first attribute in the database wins. Attributes
+        setting a GID2 never match, the SIM's is not known.
+        """
+        best_score, best_id = -1, None
+        spn = spn.lower()
+        gid1 = gid1.lower()
+        # The index lists the attributes of an mccmnc last first
+        for _, _, _, carrier_attribute, canonical_id in reversed(
+            self.index.get(mcc_mnc, ())
+        ):
+            if carrier_attribute.gid2:
+                continue
+            score = 0
+            if carrier_attribute.imsi_prefix_xpattern:
+                if not any(
+                    match_imsi_xpattern(pattern, imsi)
+                    for pattern in carrier_attribute.imsi_prefix_xpattern
+                ):
+                    continue
+                score += self.imsi_prefix_score
+            if carrier_attribute.gid1:
+                if not any(gid1.startswith(g.lower()) for g in carrier_attribute.gid1):
+                    continue
+                score += self.gid1_score
+            if carrier_attribute.spn:
+                if spn not in (s.lower() for s in carrier_attribute.spn):
+                    continue
+                score += self.spn_score
+            if score > best_score:
+                best_score, best_id = score, canonical_id
+        return best_id
+
+
+def match_imsi_xpattern(pattern, imsi):
+    """Match an IMSI against a prefix where "x" stands for any digit."""
+    if len(pattern) > len(imsi):
+        return False
+    return all(p in "xX" or p == i for p, i in zip(pattern, imsi))
+
+
+@contextmanager
+def mapped_file(filename):
+    """Map a file read-only, yielding a memoryview of its contents.
+
+    Protobuf messages parse straight from the mapping, without first copying
+    the file into a bytes object.
+    """
+    with open(filename, "rb") as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            with memoryview(mapping) as data:
+                yield data
+
+
+class DirectorySource:
+    """The protobufs of a CarrierSettings directory."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def names(self):
+        """Return the sorted file names of the protobufs."""
+        return sorted(
+            os.path.basename(filename)
+            for filename in glob(os.path.join(self.path, "*.pb"))
+        )
+
+    def key(self, name):
+        """Return the path identifying a protobuf in caches."""
+        return os.path.join(self.path, name)
+
+    def stat(self, name):
+        """Return the mtime in ns and size of a protobuf."""
+        st = os.stat(self.key(name))
+        return st.st_mtime_ns, st.st_size
+
+    def signature(self):
+        """Return a value which changes whenever a protobuf may have changed."""
+        return tuple((name,) + self.stat(name) for name in self.names())
+
+    def read(self, name):
+        """Return a context manager yielding the contents of a protobuf."""
+        return mapped_file(self.key(name))
+
+    def buffer(self, name):
+        """Return the contents of a protobuf as a memoryview, which stays valid
+        for as long as it or a slice of it is referenced."""
+        with open(self.key(name), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ArchiveSource:
+    """The protobufs of a CarrierSettings directory inside a zip or tar archive.
+
+    The archive is mapped once. Members stored without compression are read
+    straight from the mapping, compressed members are decompressed into memory.
+    If directory is None, the archive must contain exactly one directory with a
+    carrier_list.pb.
+    """
+
+    def __init__(self, archive, directory=None):
+        import tarfile
+        import zipfile
+
+        self.archive = os.path.abspath(archive)
+        with open(self.archive, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.archive_stat = st.st_mtime_ns, st.st_size
+        # Decompressing shares the archive's file object between threads
+        self.lock = threading.Lock()
+        # (offset, size) of stored members, or the member info of compressed
+        # members, by path in the archive
+        members = {}
+        if zipfile.is_zipfile(self.archive):
+            self.opened = zipfile.ZipFile(self.archive)
+            self.decompress = self.opened.read
+            for info in self.opened.infolist():
+                if info.is_dir():
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 1:
+                    # The data follows the local header, whose name and extra
+                    # field may differ from the central directory
+                    name_length, extra_length = struct.unpack_from(
+                        "<HH", self.mapping, info.header_offset + 26
+                    )
+                    offset = info.header_offset + 30 + name_length + extra_length
+                    members[info.filename] = (offset, info.file_size)
+                else:
+                    members[info.filename] = info
+        else:
+            try:
+                self.opened = tarfile.open(self.archive, "r:")
+                compressed = False
+            except tarfile.ReadError:
+                self.opened = tarfile.open(self.archive, "r:*")
+                compressed = True
+            # Not referencing self, so that the mapping is released as soon as
+            # the source is unreferenced rather than by the garbage collector
+            opened = self.opened
+            self.decompress = lambda info: opened.extractfile(info).read()
+            for info in self.opened.getmembers():
+                if not info.isfile():
+                    continue
+                if compressed or info.sparse is not None:
+                    members[info.name] = info
+                else:
+                    members[info.name] = (info.offset_data, info.size)
+
+        members = {posixpath.normpath(path): member for path, member in members.items()}
+        if directory is None:
+            directories = sorted(
+                posixpath.dirname(path)
+                for path in members
+                if posixpath.basename(path) == "carrier_list.pb"
+            )
+            if len(directories) != 1:
+                raise ValueError(
+                    f"{archive}: expected one directory containing carrier_list.pb,"
+                    f" found {directories}"
+                )
+            directory = directories[0]
+        directory = posixpath.normpath(directory).strip("/")
+        if directory == ".":
+            directory = ""
+        self.path = self.archive + "!" + directory
+        self.members = {
+            posixpath.basename(path): member
+            for path, member in members.items()
+            if posixpath.dirname(path) == directory and path.endswith(".pb")
+        }
+
+    def names(self):
+        return sorted(self.members)
+
+    def key(self, name):
+        return self.path + "/" + name
+
+    def stat(self, name):
+        # Members are considered changed whenever the archive is
+        member = self.members[name]
+        size = member[1] if isinstance(member, tuple) else member.size
+        return self.archive_stat[0], size
+
+    def signature(self):
+        return self.archive_stat
+
+    @contextmanager
+    def read(self, name):
+        member = self.members[name]
+        if isinstance(member, tuple):
+            offset, size = member
+            with memoryview(self.mapping) as mapping:
+                with mapping[offset : offset + size] as data:
+                    yield data
+        else:
+            with self.lock:
+                data = self.decompress(member)
+            yield memoryview(data)
+
+    def buffer(self, name):
+        member = self.members[name]
+        if isinstance(member, tuple):
+            offset, size = member
+            return memoryview(self.mapping)[offset : offset + size]
+        with self.lock:
+            return memoryview(self.decompress(member))
+
+
+def settings_source(pb_path):
+    """Return the source of the protobufs of pb_path.
+
+    pb_path is a CarrierSettings directory, or a zip or tar archive containing
+    one, optionally followed by "!" and the directory's path in the archive.
+    Sources returned by this function are passed through.
+    """
+    if not isinstance(pb_path, str):
+        return pb_path
+    if os.path.isdir(pb_path):
+        return DirectorySource(pb_path)
+    if os.path.isfile(pb_path):
+        return ArchiveSource(pb_path)
+    archive, _, directory = pb_path.rpartition("!")
+    if archive and os.path.isfile(archive):
+        return ArchiveSource(archive, directory)
+    raise FileNotFoundError(f"No CarrierSettings directory or archive: {pb_path}")
+
+
+# Inputs parsed by load_carrier_ids() and load_settings(), by path, together
+# with the signature of the files they were parsed from. Repeated calls from a
+# long-running process reuse them as long as the files are unchanged.
+_loaded = {}
+
+# Whether the inputs kept in _loaded may reference mapped files. A server clears
+# it: a file a build overwrites in place, rather than replaces, while it is
+# still mapped faults on access to the pages that are gone.
+_keep_mappings = True
+
+
+def _load_cached(key, signature, load):
+    cached = _loaded.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    value = load()
+    _loaded[key] = (signature, value)
+    return value
+
+
+def load_carrier_ids(android_build_top):
+    """Return a CarrierIdMatcher of the AOSP carrier_id database, which is
+    parsed on first use.
+
+    The result is cached and shared between calls, it must not be modified.
+    """
+    filename = os.path.join(
+        os.path.abspath(android_build_top), android_path_to_carrierid, "carrier_list.pb"
+    )
+    st = os.stat(filename)
+    return _load_cached(
+        ("carrier_ids", filename),
+        (st.st_mtime_ns, st.st_size),
+        lambda: CarrierIdMatcher(filename=filename),
+    )
+
+
+def parse_input(message, source, name):
+    """Parse the protobuf name of source into message and return it."""
+    with source.read(name) as data:
+        message.ParseFromString(data)
+    return message
+
+
+def load_carrier_settings(source, name):
+    from carrier_settings_pb2 import CarrierSettings
+
+    return parse_input(CarrierSettings(), source, name)
+
+
+def read_varint(data, pos):
+    """Decode the protobuf varint at pos, returning it and the following pos."""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(data):
+    """Yield the field number, wire type and value of each field of an encoded
+    protobuf message. Values of length-delimited fields are slices of data."""
+    pos = 0
+    while pos < len(data):
+        tag, pos = read_varint(data, pos)
+        field_number, wire_type = tag >> 3, tag & 7
+        match wire_type:
+            case 0:
+                value, pos = read_varint(data, pos)
+            case 1:
+                value, pos = data[pos : pos + 8], pos + 8
+            case 2:
+                length, pos = read_varint(data, pos)
+                value, pos = data[pos : pos + length], pos + length
+            case 5:
+                value, pos = data[pos : pos + 4], pos + 4
+            case _:
+                raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field_number, wire_type, value
+
+
+def index_multi_settings(data):
+    """Index the encoded settings of a MultiCarrierSettings by canonical name,
+    without decoding them.
+
+    Returns a dict of slices of data, which keep it alive. As when parsing, the
+    last setting of a canonical name wins. Serializers write a singular field
+    like canonical_name once, so only the fields up to it are scanned.
+    """
+    from carrier_settings_pb2 import CarrierSettings, MultiCarrierSettings
+
+    setting_field = MultiCarrierSettings.DESCRIPTOR.fields_by_name["setting"].number
+    name_field = CarrierSettings.DESCRIPTOR.fields_by_name["canonical_name"].number
+    index = {}
+    for field_number, wire_type, setting in iter_fields(data):
+        if field_number == setting_field and wire_type == 2:
+            index[setting_name(setting, name_field)] = setting
+    return index
+
+
+def setting_name(data, name_field=None):
+    """Return the canonical_name of an encoded CarrierSettings, without decoding
+    it. name_field is the number of the canonical_name field, if known."""
+    if name_field is None:
+        from carrier_settings_pb2 import CarrierSettings
+
+        name_field = CarrierSettings.DESCRIPTOR.fields_by_name["canonical_name"].number
+    for field_number, wire_type, value in iter_fields(data):
+        if field_number == name_field and wire_type == 2:
+            return str(value, "utf-8")
+    return ""
+
+
+def encoded_settings(source):
+    """Return the encoded CarrierSettings of a source by canonical name, as
+    load_settings() resolves them, without decoding them.
+
+    Only others.pb stays mapped. Carrier specific files are small but many, so
+    they are copied rather than each keeping a mapping and its file open.
+    """
+    settings = index_multi_settings(source.buffer("others.pb"))
+    for name in carrier_settings_files(source):
+        with source.read(name) as data:
+            data = bytes(data)
+        settings[setting_name(data)] = data
+    return settings
+
+
+def decode_setting(data, counter="generic_settings_decoded"):
+    """Decode a CarrierSettings indexed by index_multi_settings() or
+    encoded_settings(), counting it in the counter stat."""
+    from carrier_settings_pb2 import CarrierSettings
+
+    setting = CarrierSettings()
+    setting.ParseFromString(data)
+    stats.counts[counter] += 1
+    return setting
+
+
+def load_settings(pb_path):
+    """Load a CarrierSettings directory or archive, see settings_source().
+
+    Returns the CarrierList and a dict of CarrierSettings by canonical name. The
+    result is cached and shared between calls, it must not be modified.
+    """
+    source = settings_source(pb_path)
+    carrier_list, all_settings, generic_settings = _load_cached(
+        ("settings", source.path),
+        source.signature(),
+        lambda: _load_settings(source),
+    )
+    # Reported by every call, so one reusing the cached result prints and counts
+    # the same as the one which loaded it
+    stats.counts["generic_settings"] += generic_settings
+    report_overridden(all_settings.overridden)
+    return carrier_list, all_settings
+
+
+def report_overridden(canonical_names):
+    """Print and count the generic settings overridden by carrier specific
+    files."""
+    for canonical_name in canonical_names:
+        print("Overriding generic settings for " + canonical_name, file=sys.stderr)
+        stats.counts["overridden_settings"] += 1
+
+
+@stats.stage("load_settings")
+def _load_settings(source):
+    from carrier_list_pb2 import CarrierList
+
+    all_settings = LazySettings()
+    carrier_list = parse_input(CarrierList(), source, "carrier_list.pb")
+    # Load generic settings first. They are only indexed, and decoded when an
+    # entry uses them without a carrier specific file overriding them.
+    others = source.buffer("others.pb")
+    if not _keep_mappings:
+        others = bytes(others)
+    generic_settings = index_multi_settings(others)
+    for canonical_name, data in generic_settings.items():
+        all_settings.add(canonical_name, partial(decode_setting, data))
+    # Load carrier specific files last, to allow overriding generic settings.
+    # They are copied like in encoded_settings(), and decoded on first access
+    # too.
+    for name in carrier_settings_files(source):
+        with source.read(name) as data:
+            data = bytes(data)
+        # Overridden settings are listed by all_settings, and reported by
+        # load_settings()
+        all_settings.add(
+            setting_name(data),
+            partial(decode_setting, data, counter="carrier_settings_decoded"),
+        )
+    return carrier_list, all_settings, len(generic_settings)
+
+
+def carrier_settings_files(source):
+    return [
+        name
+        for name in source.names()
+        # carrier_list.pb and others.pb are handled separately
+        if name not in ("carrier_list.pb", "others.pb")
+    ]
+
+
+def settings_digest(pb_path):
+    """Hash all protobufs of a CarrierSettings directory or archive."""
+    source = settings_source(pb_path)
+    digest = hashlib.sha256()
+    for name in source.names():
+        digest.update(name.encode() + b"\0")
+        with source.read(name) as data:
+            digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+class LazySettings(Mapping):
+    """CarrierSettings by canonical name, parsed on first access."""
+
+    def __init__(self):
+        self._load = {}
+        self._settings = {}
+        # Canonical names added again, in order
+        self.overridden = []
+
+    def add(self, canonical_name, load):
+        """Make canonical_name resolve to the result of calling load()."""
+        if canonical_name in self._load:
+            self.overridden.append(canonical_name)
+        self._load[canonical_name] = load
+        self._settings.pop(canonical_name, None)
+
+    def __setitem__(self, canonical_name, setting):
+        if canonical_name in self._load:
+            self.overridden.append(canonical_name)
+        self._load[canonical_name] = None
+        self._settings[canonical_name] = setting
+
+    def __getitem__(self, canonical_name):
+        try:
+            return self._settings[canonical_name]
+        except KeyError:
+            setting = self._load[canonical_name]()
+            self._settings[canonical_name] = setting
+            return setting
+
+    def __contains__(self, canonical_name):
+        # Without parsing, unlike Mapping.__contains__
+        return canonical_name in self._load
+
+    def __iter__(self):
+        return iter(self._load)
+
+    def __len__(self):
+        return len(self._load)
+
+
+class ExtractionCache:
+    """On-disk cache used by --cache-dir for incremental re-extraction.
+
+    It remembers the hash and canonical names of every input protobuf by mtime
+    and size, so unchanged files are neither hashed nor parsed again, and the
+    rendered apn and carrier_config fragments of every carrier_list entry. A
+    fragment is reused as long as the file its setting comes from, the entry's
+    carrier_id and everything else it was rendered with are unchanged.
+    """
+
+    # Must be increased whenever the rendering of fragments changes
+    version = 1
+
+    def __init__(self, cache_dir, name):
+        self.filename = os.path.join(cache_dir, name + ".json")
+        self.files = {}
+        self.fragments = {}
+        self.used_fragments = {}
+        # Hash of the file each canonical name is loaded from
+        self.setting_digests = {}
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if data is not None and data.get("version") == self.version:
+            self.files = data["files"]
+            self.fragments = data["fragments"]
+
+    def file_info(self, source, name, parse):
+        """Return the hash and canonical names of the protobuf name of source.
+
+        If the file changed since it was cached, parse is called with its
+        contents and must return the canonical names and the parsed message,
+        which is returned as well. Otherwise the message is None.
+        """
+        key = source.key(name)
+        mtime_ns, size = source.stat(name)
+        cached = self.files.get(key)
+        if cached is not None and cached[:2] == [mtime_ns, size]:
+            return cached[2], cached[3], None
+        with source.read(name) as data:
+            canonical_names, message = parse(data)
+            digest = hashlib.sha256(data).hexdigest()
+        self.files[key] = [mtime_ns, size, digest, canonical_names]
+        return digest, canonical_names, message
+
+    def fragment(self, kind, entry, extra, render):
+        """Return the cached fragment of an entry, or render and cache it."""
+        key = hashlib.sha256(
+            repr(
+                (
+                    kind,
+                    entry.canonical_name,
+                    self.setting_digests[entry.canonical_name],
+                    entry.carrier_id[0].SerializeToString(deterministic=True),
+                    extra,
+                )
+            ).encode()
+        ).hexdigest()
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = render()
+            stats.counts["fragments_rendered"] += 1
+        else:
+            stats.counts["fragments_reused"] += 1
+        self.used_fragments[key] = fragment
+        return fragment
+
+    @staticmethod
+    def render_fragment(cache, kind, entry, extra, render):
+        """Return the fragment of an entry from cache, an ExtractionCache, or
+        render() it if cache is None.
+
+        render looks up the entry's settings itself, so that they are only
+        decoded when a fragment is rendered rather than reused.
+        """
+        if cache is None:
+            return render()
+        return cache.fragment(kind, entry, extra, render)
+
+    def save(self):
+        """Write the cache, keeping only the fragments used by this run."""
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp = self.filename + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": self.version,
+                    "files": self.files,
+                    "fragments": self.used_fragments,
+                },
+                f,
+            )
+        os.replace(temp, self.filename)
+
+
+@stats.stage("load_settings")
+def load_settings_incremental(pb_path, cache):
+    """Load a CarrierSettings directory like load_settings(), but only parse the
+    files which changed since they were recorded in cache.
+
+    Settings of unchanged files, and generic settings, are parsed on first
+    access.
+    """
+    from carrier_list_pb2 import CarrierList
+    from carrier_settings_pb2 import CarrierSettings
+
+    source = settings_source(pb_path)
+
+    def parse_others(data):
+        return list(index_multi_settings(data)), None
+
+    def parse_setting(data):
+        setting = CarrierSettings()
+        setting.ParseFromString(data)
+        return [setting.canonical_name], setting
+
+    carrier_list = parse_input(CarrierList(), source, "carrier_list.pb")
+    all_settings = LazySettings()
+
+    # Load generic settings first
+    digest, canonical_names, _ = cache.file_info(source, "others.pb", parse_others)
+    generic_settings = {}
+
+    def load_generic(canonical_name):
+        if not generic_settings:
+            generic_settings.update(index_multi_settings(source.buffer("others.pb")))
+        return decode_setting(generic_settings[canonical_name])
+
+    stats.counts["generic_settings"] += len(canonical_names)
+    for canonical_name in canonical_names:
+        all_settings.add(canonical_name, partial(load_generic, canonical_name))
+        cache.setting_digests[canonical_name] = digest
+    # Load carrier specific files last, to allow overriding generic settings
+    for name in carrier_settings_files(source):
+        digest, (canonical_name,), setting = cache.file_info(
+            source, name, parse_setting
+        )
+        if canonical_name in all_settings:
+            print(
+                "Overriding generic settings for " + canonical_name,
+                file=sys.stderr,
+            )
+            stats.counts["overridden_settings"] += 1
+        if setting is None:
+            all_settings.add(
+                canonical_name, partial(load_carrier_settings, source, name)
+            )
         else:
-            setting = CarrierSettings()
-            setting.ParseFromString(pb.read())
-            if setting.canonical_name in all_settings:
-                print(
-                    "Overriding generic settings for " + setting.canonical_name,
-                    file=sys.stderr,
+            all_settings[canonical_name] = setting
+        cache.setting_digests[canonical_name] = digest
+    return carrier_list, all_settings
+
+
+class ResolvedCarrierIds:
+    """The canonical ids of carrier_list CarrierIds, as resolved by a
+    CarrierIdMatcher whose digest was digest.
+
+    It stands in for the matcher when rendering from a Snapshot. Only lookup()
+    is supported, and only for the CarrierIds it was built from.
+    """
+
+    def __init__(self, canonical_ids, digest):
+        self.canonical_ids = canonical_ids
+        self.digest = digest
+
+    @staticmethod
+    def key(carrier_id):
+        return carrier_id.mcc_mnc, carrier_id.imsi, carrier_id.spn, carrier_id.gid1
+
+    @classmethod
+    def resolve(cls, carrier_list, carrier_id_matcher):
+        canonical_ids = {}
+        for entry in carrier_list.entry:
+            for carrier_id in entry.carrier_id:
+                canonical_ids[cls.key(carrier_id)] = carrier_id_matcher.lookup(
+                    carrier_id
                 )
-            all_settings[setting.canonical_name] = setting
+        return cls(canonical_ids, carrier_id_matcher.digest)
+
+    def lookup(self, carrier_id):
+        return self.canonical_ids[self.key(carrier_id)]
+
+
+class Snapshot:
+    """The resolved inputs of an extraction, stored in a single file.
+
+    A snapshot holds the carrier_list, the CarrierSettings of its entries after
+    carrier specific files overrode generic settings, and the canonical ids of
+    its CarrierIds. It is mapped, and settings are decoded on first access, so
+    opening one costs little more than reading its header.
+
+    The file starts with the magic, the format version and the length of a
+    UTF-8 JSON header as two little-endian uint32. The header maps "carrier_list"
+    and each canonical name in "settings" to the [offset, length] of the
+    serialized message in the data following it, and also holds:
+
+    * "key": hash of the input protobufs and carrier_id database contents
+    * "inputs": signature of the inputs by path, mtime and size
+    * "digests": hash of each serialized setting by canonical name
+    * "carrier_ids": [mcc_mnc, imsi, spn, gid1, canonical id or null] lists
+    * "carrier_id_digest": hash of the carrier_id database
+    * "overridden": canonical names overridden by carrier specific files
+    """
+
+    magic = b"CSSNAP\0\0"
+    # Must be increased whenever the layout or content changes
+    version = 1
+    header_format = "<8sII"
+
+    def __init__(self, filename):
+        """Open a snapshot, raising ValueError if it is not one of this version."""
+        with open(filename, "rb") as f:
+            self.data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        header_size = struct.calcsize(self.header_format)
+        if len(self.data) < header_size:
+            raise ValueError(f"{filename}: not a snapshot")
+        magic, version, length = struct.unpack_from(self.header_format, self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError(f"{filename}: not a version {self.version} snapshot")
+        self.header = json.loads(
+            str(self.data[header_size : header_size + length], "utf-8")
+        )
+        self.base = header_size + length
+        self.key = self.header["key"]
+        self.inputs = self.header["inputs"]
+        self.setting_digests = self.header["digests"]
+        self.overridden = self.header["overridden"]
+        self.carrier_ids = ResolvedCarrierIds(
+            {tuple(row[:4]): row[4] for row in self.header["carrier_ids"]},
+            self.header["carrier_id_digest"],
+        )
+        self.settings = LazySettings()
+        for canonical_name, location in self.header["settings"].items():
+            self.settings.add(canonical_name, partial(self._decode, location))
+
+    def blob(self, location):
+        offset, length = location
+        return self.data[self.base + offset : self.base + offset + length]
+
+    def _decode(self, location):
+        from carrier_settings_pb2 import CarrierSettings
+
+        setting = CarrierSettings()
+        setting.ParseFromString(self.blob(location))
+        stats.counts["snapshot_settings_decoded"] += 1
+        return setting
+
+    @property
+    def carrier_list(self):
+        from carrier_list_pb2 import CarrierList
+
+        carrier_list = CarrierList()
+        carrier_list.ParseFromString(self.blob(self.header["carrier_list"]))
+        return carrier_list
+
+    @classmethod
+    def write(cls, filename, key, inputs, carrier_list, all_settings, carrier_ids):
+        """Write a snapshot of carrier_list and the settings of its entries."""
+        blobs = []
+        size = 0
+
+        def add(blob):
+            nonlocal size
+            blobs.append(blob)
+            size += len(blob)
+            return [size - len(blob), len(blob)]
+
+        header = {
+            "key": key,
+            "inputs": inputs,
+            "carrier_list": add(carrier_list.SerializeToString()),
+            "settings": {},
+            "digests": {},
+            "carrier_ids": [
+                list(carrier_id) + [canonical_id]
+                for carrier_id, canonical_id in carrier_ids.canonical_ids.items()
+            ],
+            "carrier_id_digest": carrier_ids.digest,
+            "overridden": getattr(all_settings, "overridden", []),
+        }
+        for entry in carrier_list.entry:
+            if entry.canonical_name not in header["settings"]:
+                blob = all_settings[entry.canonical_name].SerializeToString()
+                header["settings"][entry.canonical_name] = add(blob)
+                header["digests"][entry.canonical_name] = hashlib.sha256(
+                    blob
+                ).hexdigest()
+        cls._write_file(filename, header, blobs)
+
+    def write_inputs(self, filename, inputs):
+        """Rewrite this snapshot to filename with another inputs signature, for
+        inputs whose contents are unchanged."""
+        self._write_file(
+            filename,
+            dict(self.header, inputs=inputs),
+            [self.blob([0, len(self.data) - self.base])],
+        )
+        self.inputs = inputs
+
+    @classmethod
+    def _write_file(cls, filename, header, blobs):
+        header = json.dumps(header).encode()
+        temp = filename + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(struct.pack(cls.header_format, cls.magic, cls.version, len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(temp, filename)
+
+
+def snapshot_key(source, carrier_id_matcher):
+    """Hash the contents of the inputs of a snapshot."""
+    return hashlib.sha256(
+        repr((settings_digest(source), carrier_id_matcher.digest)).encode()
+    ).hexdigest()
+
+
+def load_snapshot(filename, pb_path, carrier_id_matcher):
+    """Return the Snapshot of pb_path and the carrier_id database of
+    carrier_id_matcher stored in filename, writing it first if it is missing
+    or was made from other inputs."""
+    source = settings_source(pb_path)
+    # The carrier_id database is only parsed if its signature changed
+    inputs = repr(
+        (
+            source.path,
+            source.signature(),
+            carrier_id_matcher.signature or carrier_id_matcher.digest,
+        )
+    )
+    key = None
+    with stats.stage("load_snapshot"):
+        try:
+            snapshot = Snapshot(filename)
+        except (OSError, ValueError):
+            snapshot = None
+        # Inputs whose mtime changed are hashed to tell if their contents did
+        if snapshot is not None and snapshot.inputs != inputs:
+            key = snapshot_key(source, carrier_id_matcher)
+            if snapshot.key != key:
+                snapshot = None
+            else:
+                # Record the new mtimes, so the next runs do not hash again
+                snapshot.write_inputs(filename, inputs)
+                stats.counts["snapshot_inputs_updated"] += 1
+    if snapshot is not None:
+        report_overridden(snapshot.overridden)
+        return snapshot
+
+    carrier_list, all_settings = load_settings(source)
+    with stats.stage("write_snapshot"):
+        Snapshot.write(
+            filename,
+            key or snapshot_key(source, carrier_id_matcher),
+            inputs,
+            carrier_list,
+            all_settings,
+            ResolvedCarrierIds.resolve(carrier_list, carrier_id_matcher),
+        )
+        return Snapshot(filename)
 
 
 # Unfortunately, python processors like xml and lxml, as well as command-line
@@ -93,271 +1082,138 @@ for filename in glob(os.path.join(pb_path, "*.pb")):
 # Therefore, we build the file without using an XML processor.
 
 
+# ApnItem fields written as apn attributes, by attribute name, before and after
+# the MVNO attributes taken from the carrier_id
+apn_fields_before_mvno = [
+    ("apn", "value"),
+    ("proxy", "proxy"),
+    ("port", "port"),
+    ("mmsc", "mmsc"),
+    ("mmsproxy", "mmsc_proxy"),
+    ("mmsport", "mmsc_proxy_port"),
+    ("user", "user"),
+    ("password", "password"),
+    ("server", "server"),
+    ("authtype", "authtype"),
+    ("type", "type"),
+    ("protocol", "protocol"),
+    ("roaming_protocol", "roaming_protocol"),
+    ("bearer_bitmask", "bearer_bitmask"),
+    ("profile_id", "profile_id"),
+    ("modem_cognitive", "modem_cognitive"),
+    ("max_conns", "max_conns"),
+    ("wait_time", "wait_time"),
+    ("max_conns_time", "max_conns_time"),
+    ("mtu", "mtu"),
+]
+apn_fields_after_mvno = [
+    ("apn_set_id", "apn_set_id"),
+    # No source for integer carrier_id?
+    ("skip_464xlat", "skip_464xlat"),
+    ("user_visible", "user_visible"),
+    ("user_editable", "user_editable"),
+]
+
+# Absolutely horrendous fix to stop NumberFormatException
+apn_enum_values = {
+    "SKIP_464XLAT_DEFAULT": "-1",
+    "SKIP_464XLAT_DISABLE": "0",
+    "SKIP_464XLAT_ENABLE": "1",
+}
+
+# (attribute, field, repeated, format) columns by ApnItem descriptor
+_apn_columns = {}
+
+
+def apn_columns(descriptor):
+    """Resolve the apn_fields_* tables against the ApnItem descriptor once.
+
+    Returns the columns before and after the MVNO attributes as lists of
+    (attribute, field, repeated, format) tuples, where format converts a field
+    value to its attribute value.
+    """
+    columns = _apn_columns.get(descriptor)
+    if columns is not None:
+        return columns
+    columns = []
+    for fields in [apn_fields_before_mvno, apn_fields_after_mvno]:
+        columns.append([])
+        for key, field in fields:
+            field_descriptor = descriptor.fields_by_name[field]
+            # Only repeated fields default to an empty list (FieldDescriptor.label
+            # is gone from recent protobuf releases)
+            repeated = field_descriptor.default_value == []
+            if field_descriptor.enum_type is not None:
+                names = {
+                    value.number: apn_enum_values.get(value.name, value.name)
+                    for value in field_descriptor.enum_type.values
+                }
+                if repeated:
+                    # List of enum names, e.g. type="default,supl"
+                    def value_format(values, names=names):
+                        return ",".join(names[i] for i in values).lower()
+
+                else:
+                    value_format = names.__getitem__
+            elif field_descriptor.type == field_descriptor.TYPE_BOOL:
+
+                def value_format(value):
+                    return "true" if value else "false"
+
+            else:
+                value_format = str
+            columns[-1].append((key, field, repeated, value_format))
+    _apn_columns[descriptor] = columns
+    return columns
+
+
+def apn_attributes(apn):
+    """Return the attributes taken from an ApnItem, as lists of (key, value)
+    tuples before and after the MVNO attributes."""
+    attributes = []
+    for columns in apn_columns(apn.DESCRIPTOR):
+        attributes.append([])
+        for key, field, repeated, value_format in columns:
+            if repeated or apn.HasField(field):
+                attributes[-1].append((key, value_format(getattr(apn, field))))
+    return attributes
+
+
+def carrier_attributes(carrier_id, carrier_id_matcher):
+    """Return the apn attributes taken from a carrier_list CarrierId, as lists of
+    (key, value) tuples before the ApnItem attributes and in place of the MVNO
+    attributes."""
+    attributes = []
+    canonical_id = carrier_id_matcher.lookup(carrier_id)
+    if canonical_id is None:
+        stats.counts["carrier_id_misses"] += 1
+    else:
+        stats.counts["carrier_id_hits"] += 1
+        attributes.append(("carrier_id", str(canonical_id)))
+    attributes.append(("mcc", carrier_id.mcc_mnc[:3]))
+    attributes.append(("mnc", carrier_id.mcc_mnc[3:]))
+    mvno_attributes = []
+    mvno = carrier_id.WhichOneof("mvno_data")
+    if mvno:
+        mvno_attributes.append(("mvno_type", "gid" if mvno.startswith("gid") else mvno))
+        mvno_attributes.append(("mvno_match_data", getattr(carrier_id, mvno)))
+    return attributes, mvno_attributes
+
+
 class ApnElement:
-    def __init__(self, apn, carrier_id):
+    def __init__(self, apn, carrier_id, carrier_id_matcher):
         self.apn = apn
         self.carrier_id = carrier_id
+        self.carrier_id_matcher = carrier_id_matcher
         self.attributes = OrderedDict()
         self.add_attributes()
 
-    def add_attribute(self, key, field=None, value=None):
-        if value is not None:
-            self.attributes[key] = value
-        else:
-            if field is None:
-                field = key
-            if self.apn.HasField(field):
-                enum_type = self.apn.DESCRIPTOR.fields_by_name[field].enum_type
-                value = getattr(self.apn, field)
-                if enum_type is None:
-                    if isinstance(value, bool):
-                        self.attributes[key] = str(value).lower()
-                    else:
-                        self.attributes[key] = str(value)
-                else:
-                    self.attributes[key] = enum_type.values_by_number[value].name
-
     def add_attributes(self):
-        try:
-            self.add_attribute(
-                "carrier_id",
-                value=str(
-                    carrier_attribute_map[
-                        (
-                            self.carrier_id.mcc_mnc,
-                            self.carrier_id.imsi,
-                            self.carrier_id.spn.lower(),
-                            "",
-                            self.carrier_id.gid1.lower(),
-                            "",
-                            "",
-                            "",
-                        )
-                    ]
-                ),
-            )
-        except KeyError:
-            pass
-        self.add_attribute("mcc", value=self.carrier_id.mcc_mnc[:3])
-        self.add_attribute("mnc", value=self.carrier_id.mcc_mnc[3:])
-        self.add_attribute("apn", "value")
-        self.add_attribute("proxy")
-        self.add_attribute("port")
-        self.add_attribute("mmsc")
-        self.add_attribute("mmsproxy", "mmsc_proxy")
-        self.add_attribute("mmsport", "mmsc_proxy_port")
-        self.add_attribute("user")
-        self.add_attribute("password")
-        self.add_attribute("server")
-        self.add_attribute("authtype")
-        self.add_attribute(
-            "type",
-            value=",".join(
-                apn.DESCRIPTOR.fields_by_name["type"].enum_type.values_by_number[i].name
-                for i in self.apn.type
-            ).lower(),
-        )
-        self.add_attribute("protocol")
-        self.add_attribute("roaming_protocol")
-        self.add_attribute("bearer_bitmask")
-        self.add_attribute("profile_id")
-        self.add_attribute("modem_cognitive")
-        self.add_attribute("max_conns")
-        self.add_attribute("wait_time")
-        self.add_attribute("max_conns_time")
-        self.add_attribute("mtu")
-        mvno = self.carrier_id.WhichOneof("mvno_data")
-        if mvno:
-            self.add_attribute(
-                "mvno_type",
-                value="gid" if mvno.startswith("gid") else mvno,
-            )
-            self.add_attribute(
-                "mvno_match_data",
-                value=getattr(self.carrier_id, mvno),
-            )
-        self.add_attribute("apn_set_id")
-        # No source for integer carrier_id?
-        self.add_attribute("skip_464xlat")
-        self.add_attribute("user_visible")
-        self.add_attribute("user_editable")
-
-
-def indent(elem, level=0):
-    """Based on https://effbot.org/zone/element-lib.htm#prettyprint"""
-    i = "\n" + level * "    "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "    "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
-
-# Anything where the value is a package name
-unwanted_configs = [
-    "carrier_settings_activity_component_name_string",
-    "carrier_setup_app_string",
-    "config_ims_package_override_string",
-    "enable_apps_string_array",
-    "gps.nfw_proxy_apps",
-    "ci_action_on_sys_update_bool",
-    "ci_action_on_sys_update_extra_string",
-    "ci_action_on_sys_update_extra_val_string",
-    "ci_action_on_sys_update_intent_string",
-    "allow_adding_apns_bool",
-    "apn_expand_bool",
-    "hide_ims_apn_bool",
-    "hide_preset_apn_details_bool",
-    "read_only_apn_fields_string_array",
-    "read_only_apn_types_string_array",
-    "show_apn_setting_cdma_bool",
-    "carrier_provisioning_app_string",
-    "hide_enable_2g_bool",
-    "com.google.android.dialer.display_wifi_calling_button_bool",
-    "config_ims_rcs_package_override_string",
-    "editable_enhanced_4g_lte_bool",
-    "hide_enhanced_4g_lte_bool",
-    "vonr_setting_visibility_bool",
-    "editable_wfc_mode_bool",
-    "editable_wfc_roaming_mode_bool",
-    "moto_WEA3_overshoot_allowed",
-    "moto_additional_international_roaming_network_string_array",
-    "moto_allow_hold_in_gsm_call",
-    "moto_app_directed_sms_enabled",
-    "moto_append_filler_digits_to_iccid",
-    "moto_auto_answer",
-    "moto_auto_resume_holding_call",
-    "moto_auto_resume_holding_call",
-    "moto_auto_retry_enabled",
-    "moto_back_to_auto_network_selection_timer",
-    "moto_call_end_tone_and_call_end_toast",
-    "moto_carrier_airplane_mode_alert_bool",
-    "moto_carrier_chatbot_supported_bool",
-    "moto_carrier_chatbot_supported_bool",
-    "moto_carrier_fdn_numbers_string_array",
-    "moto_carrier_format_device_info",
-    "moto_carrier_hide_meid",
-    "moto_carrier_specific_rtt_req_bool",
-    "moto_carrier_specific_vice_req_bool",
-    "moto_carrier_specific_vt_req_bool",
-    "moto_carrier_specific_wfc_req_bool",
-    "moto_carrier_vonr_available_bool",
-    "moto_cdma_dbm_thresholds_int_array",
-    "moto_cdma_ecio_thresholds_int_array",
-    "moto_check_camped_csg_bool",
-    "moto_common_rtt_enabled_bool",
-    "moto_convert_plus_for_ims_call_bool",
-    "moto_custom_config_string",
-    "moto_customized_vvm_in_dialer_bool",
-    "moto_default_disable_initial_addressbook_scan_value_int",
-    "moto_delete_WEA_database",
-    "moto_disable_2g_bool",
-    "moto_display_noservice_dataiwlan_wificallingdisable",
-    "moto_dss_int",
-    "moto_ecbm_supported_bool",
-    "moto_enable_bcch_location_service",
-    "moto_enable_broadcast_phone_state_change",
-    "moto_enable_service_dialing_number",
-    "moto_enable_ussd_alert",
-    "moto_enriched_call_common_bool",
-    "moto_eri_banner",
-    "moto_evdo_dbm_thresholds_int_array",
-    "moto_evdo_ecio_thresholds_int_array",
-    "moto_evdo_snr_thresholds_int_array",
-    "moto_hide_delete_action_for_non_user_deletable_apn",
-    "moto_hide_roaming_option_on_settings",
-    "moto_hide_smsc_edit_option_bool",
-    "moto_hide_wfc_mode_summary",
-    "moto_ignore_ir94videoauth_for_video_calls",
-    "moto_ims_call_priority_over_ussd_bool",
-    "moto_ims_callcomposer_default_usersetting_bool",
-    "moto_ims_useragent_format_str",
-    "moto_ir94videoauth_default_int",
-    "moto_launch_browser_for_captiveportal_mobile_bool",
-    "moto_lppe_available_bool",
-    "moto_lte_rsrp_thresholds_per_band_string_array",
-    "moto_lte_show_one_bar_atleast_bool",
-    "moto_mms_gowith_ims_rat_bool",
-    "moto_mt_sms_filter_list",
-    "moto_mt_sms_filter_list",
-    "moto_multi_device_support",
-    "moto_need_delay_otasp",
-    "moto_operator_name_replace_string_array",
-    "moto_preferred_display_name",
-    "moto_prefix_block",
-    "moto_prefix_block_bool",
-    "moto_prompt_call_ap_mode",
-    "moto_redial_alternate_service_call_over_cs",
-    "moto_rtt_while_roaming_supported_bool",
-    "moto_should_restore_anonymous_bool",
-    "moto_should_restore_unknown_participant_bool",
-    "moto_show_5g_warning_on_volte_off_bool",
-    "moto_show_brazil_settings",
-    "moto_show_customized_wfc_disclaimer_dialog",
-    "moto_show_customized_wfc_help_and_dialog_bool",
-    "moto_show_unsecured_wifi_network_dialog",
-    "moto_show_wfc_ussd_disclaimer_bool",
-    "moto_signal_strength_hysteresis_db_int",
-    "moto_signal_strength_max_level_int",
-    "moto_sprint_hd_codec",
-    "moto_ssrsrp_signal_strength_hysteresis_db_int",
-    "moto_ssrsrp_signal_threshold_offset_frequency_range_high_int",
-    "moto_ssrsrp_signal_threshold_offset_frequency_range_low_int",
-    "moto_ssrsrp_signal_threshold_offset_frequency_range_mid_int",
-    "moto_ssrsrp_signal_threshold_offset_frequency_range_mmwave_int",
-    "moto_sssinr_signal_strength_hysteresis_db_int",
-    "moto_stir_shaken_common_req_bool",
-    "moto_tdscdma_rscp_thresholds_int_array",
-    "moto_uce_messaging_feature_enabled_bool",
-    "moto_uce_video_feature_enabled_bool",
-    "moto_update_cb_with_password_over_ims",
-    "moto_update_ims_useragent_bool",
-    "moto_use_only_cdmadbm_for_cdma_signal_bar_bool",
-    "moto_use_only_evdodbm_for_evdo_signal_bar_bool",
-    "moto_use_restore_number_for_conference",
-    "moto_vt_common_req_bool",
-    "moto_vzw_voice_call_worldphone",
-    "moto_vzw_volte_specific_req",
-    "moto_vzw_wfc_enabled_bool",
-    "moto_vzw_world_phone",
-    "moto_wcdma_ecno_thresholds_int_array",
-    "moto_wcdma_rssi_thresholds_int_array",
-    "moto_wfc_spn",
-    "mtk_emc_rtt_guard_timer_bool",
-    "mtk_key_vt_downgrade_in_bad_bitrate",
-    "mtk_mt_rtt_without_precondition_bool",
-    "mtk_rtt_audio_indication_supported_bool",
-    "mtk_rtt_video_switch_supported_bool",
-    "carrier_moto_allow_calls_over_IMS_only_bool",
-    "moto_carrier_default_vonr_bool",
-    "moto_disable_5GSA_during_wfc_call",
-    "moto_networkstate_pingpong_supported_bool",
-    "moto_networkstate_service_support_bool",
-    "moto_networkstate_pingpong_supported_bool ",
-    "moto_networkstate_service_support_bool ",
-    "moto_smart_5g_enabled_bool",
-    "moto_smart_5g_supported_bool",
-    "moto_support_data_stall_detect_bool",
-    "moto_support_data_stall_detect_bool ",
-    "moto_sync_nrband_list_bool",
-    "moto_wifi_cellular_switch_enabled_bool",
-    "moto_cs_call_barring_service_class_int",
-    "moto_user_default_nr_mode",
-    "moto_force_apn_mvno_type_priority_string",
-    "moto_config_spn_display_rule_array",
-    "call_redirection_service_component_name_string",
-    "carrier_vvm_package_name_string",
-    
-]
+        carrier, mvno = carrier_attributes(self.carrier_id, self.carrier_id_matcher)
+        before_mvno, after_mvno = apn_attributes(self.apn)
+        for attributes in [carrier, before_mvno, mvno, after_mvno]:
+            self.attributes.update(attributes)
 
-unwanted_configs_tensor = ["smart_forwarding_config_component_name_string"]
 
 qualcomm_pixels = [
     "crosshatch",
@@ -373,171 +1229,1993 @@ qualcomm_pixels = [
 ]
 
 
-def gen_config_tree(parent, config):
-    if config.key in unwanted_configs:
-        return
-    if (config.key in unwanted_configs_tensor) and (device not in qualcomm_pixels):
-        return
-    value_type = config.WhichOneof("value")
-    match value_type:
-        case "text_value":
-            # we do not ship proprietary carrier apps, only write values where it uses
-            # AOSP ImsServiceEntitlement. fixes broken wi-fi calling on some carriers
-            # for sandboxed Google Play users
-            if (config.key == "wfc_emergency_address_carrier_app_string") and (
-                str(getattr(config, value_type))
-                != "com.android.imsserviceentitlement/.WfcActivationActivity"
-            ):
-                return
-            sub_element = ET.SubElement(parent, "string")
-            sub_element.set("name", config.key)
-            sub_element.text = getattr(config, value_type)
-        case "int_value":
-            sub_element = ET.SubElement(parent, "int")
-            sub_element.set("name", config.key)
-            sub_element.set("value", str(getattr(config, value_type)))
-        case "long_value":
-            sub_element = ET.SubElement(parent, "long")
-            sub_element.set("name", config.key)
-            sub_element.set("value", str(getattr(config, value_type)))
-        case "bool_value":
-            sub_element = ET.SubElement(parent, "boolean")
-            sub_element.set("name", config.key)
-            sub_element.set("value", str(getattr(config, value_type)).lower())
-        case "text_array":
-            items = getattr(config, value_type).item
-            # we do not ship "com.google.android.carriersetup", remove it from
-            # carrier_app_wake_signal_config
-            if config.key == "carrier_app_wake_signal_config":
-                items = [
-                    item
-                    for item in items
-                    if ("com.google.android.carriersetup/" not in str(item) or "com.motorola" not in str(item))
-                ]
-                # if there's only 1 value defined ("com.google.android.carriersetup") in
-                # the list, just return so we're not writing an array of 0 values
-                if len(items) == 0:
-                    return
-            sub_element = ET.SubElement(parent, "string-array")
-            sub_element.set("name", config.key)
-            sub_element.set("num", str(len(items)))
-            for value in items:
-                ET.SubElement(sub_element, "item").set("value", value)
-        case "int_array":
-            items = getattr(config, value_type).item
-            sub_element = ET.SubElement(parent, "int-array")
-            sub_element.set("name", config.key)
-            sub_element.set("num", str(len(items)))
-            for value in items:
-                ET.SubElement(sub_element, "item").set("value", str(value))
-        case "bundle":
-            sub_element = ET.SubElement(parent, "pbundle_as_map")
-            sub_element.set("name", config.key)
-            configs = getattr(config, value_type).config
-            for sub_config in configs:
-                gen_config_tree(sub_element, sub_config)
-        case "double_value":
-            raise TypeError(f"Found Config value type: {value_type}")
-            sub_element = ET.SubElement(parent, "double")
-            sub_element.set("name", config.key)
-            sub_element.set("value", str(getattr(config, value_type)))
-        case _:
-            print(f"Unknown Config value type: {value_type}")
-            return
+def load_config_rules(filename=None):
+    """Read the rules of an unwanted_configs.txt file.
 
+    Returns a list of (section, rule) tuples. Without a filename, the file
+    shipped next to this script is read.
+    """
+    if filename is None:
+        data = __loader__.get_data(
+            os.path.join(os.path.dirname(__file__), "unwanted_configs.txt")
+        ).decode("utf-8")
+    else:
+        with open(filename, encoding="utf-8") as f:
+            data = f.read()
+    rules = []
+    section = "all"
+    for line_number, line in enumerate(data.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1]
+            if section not in ("all", "tensor"):
+                raise ValueError(
+                    f"{filename or 'unwanted_configs.txt'}:{line_number}: "
+                    f"unknown section {line}"
+                )
+            continue
+        rules.append((section, line))
+    return rules
 
-carrier_config_root = ET.Element("carrier_config_list")
 
-with open(apn_out, "w", encoding="utf-8") as f:
-    f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n\n')
-    f.write('<apns version="8">\n\n')
+class ConfigFilter:
+    """Decide which configs of a device are written to carrierconfig-vendor.xml.
 
-    for entry in carrier_list.entry:
-        setting = all_settings[entry.canonical_name]
-        for apn in setting.apns.apn:
-            f.write("  <apn carrier={}\n".format(quoteattr(apn.name)))
-            apn_element = ApnElement(apn, entry.carrier_id[0])
-            for key, value in apn_element.attributes.items():
-                # Absolutely horrendous fix to stop NumberFormatException
-                value = value.replace("SKIP_464XLAT_DEFAULT", "-1")
-                value = value.replace("SKIP_464XLAT_DISABLE", "0")
-                value = value.replace("SKIP_464XLAT_ENABLE", "1")
-                f.write("      {}={}\n".format(escape(key), quoteattr(value)))
-            f.write("  />\n\n")
-
-        carrier_config_element = ET.SubElement(
-            carrier_config_root,
-            "carrier_config",
-        )
-        carrier_config_element.set("mcc", entry.carrier_id[0].mcc_mnc[:3])
-        carrier_config_element.set("mnc", entry.carrier_id[0].mcc_mnc[3:])
-        for field in ["spn", "imsi", "gid1"]:
-            if entry.carrier_id[0].HasField(field):
-                carrier_config_element.set(
-                    field,
-                    getattr(entry.carrier_id[0], field),
+    The key rules read by load_config_rules() are compiled once per device into
+    a set of exact keys and a list of prefixes. The filter also applies the rules
+    which depend on config values, and counts how many configs each rule drops.
+    """
+
+    # Increased whenever the rules implemented in code change
+    version = 1
+
+    def __init__(self, rules, device):
+        self.keys = {}
+        self.prefixes = []
+        applied = []
+        for section, rule in rules:
+            if section == "tensor" and device in qualcomm_pixels:
+                continue
+            applied.append(rule)
+            if rule.endswith("*"):
+                self.prefixes.append((rule[:-1], rule))
+            else:
+                self.keys[rule] = rule
+        self.prefixes = tuple(self.prefixes)
+        # Identifies the filtering of this device in caches
+        self.digest = hashlib.sha256(
+            repr((self.version, sorted(set(applied)))).encode()
+        ).hexdigest()
+        self.counts = Counter()
+
+    def drop_key(self, key):
+        """Return whether the config key is unwanted."""
+        rule = self.keys.get(key)
+        if rule is None:
+            for prefix, prefix_rule in self.prefixes:
+                if key.startswith(prefix):
+                    rule = prefix_rule
+                    break
+            else:
+                return False
+        self.counts[rule] += 1
+        return True
+
+    def drop_text(self, key, value):
+        """Return whether a text config is unwanted because of its value."""
+        # we do not ship proprietary carrier apps, only write values where it uses
+        # AOSP ImsServiceEntitlement. fixes broken wi-fi calling on some carriers
+        # for sandboxed Google Play users
+        if (key == "wfc_emergency_address_carrier_app_string") and (
+            str(value) != "com.android.imsserviceentitlement/.WfcActivationActivity"
+        ):
+            self.counts[key + " != ImsServiceEntitlement"] += 1
+            return True
+        return False
+
+    def filter_items(self, key, items):
+        """Return the wanted items of a text array config."""
+        # we do not ship "com.google.android.carriersetup", remove it from
+        # carrier_app_wake_signal_config
+        if key == "carrier_app_wake_signal_config":
+            wanted = [
+                item
+                for item in items
+                if (
+                    "com.google.android.carriersetup/" not in str(item)
+                    or "com.motorola" not in str(item)
                 )
+            ]
+            self.counts[key + " items"] += len(items) - len(wanted)
+            return wanted
+        return items
 
-        for config in setting.configs.config:
-            gen_config_tree(carrier_config_element, config)
 
-    f.write("</apns>\n")
+# (rules, compiled ConfigFilter) by device and rules file
+_config_filters = {}
 
-indent(carrier_config_root)
-carrier_config_tree = ET.ElementTree(carrier_config_root)
-root_carrier_config_tree = carrier_config_tree.getroot()
-
-# dict containing lookups for each mccmnc combo representing each file,
-# which contains a list of all configs which are dicts
-carrier_config_mccmnc_aggregated = {}
-
-for lone_carrier_config in root_carrier_config_tree:
-    # append mnc to mcc to form identifier used to lookup carrier XML in CarrierConfig
-    # app
-    if (
-        ("gid1" not in lone_carrier_config.attrib)
-        and ("spn" not in lone_carrier_config.attrib)
-        and ("imsi" not in lone_carrier_config.attrib)
-    ):
-        front = True
+
+def compile_config_filter(device, rules_file=None):
+    """Return the ConfigFilter of a device, compiling it on first use.
+
+    The rules file is read again on every call, and the filter compiled again
+    if its rules changed, so that a long-running process picks up edits.
+    """
+    rules = load_config_rules(rules_file)
+    cached = _config_filters.get((device, rules_file))
+    if cached is None or cached[0] != rules:
+        cached = _config_filters[device, rules_file] = (
+            rules,
+            ConfigFilter(rules, device),
+        )
+    return cached[1]
+
+
+# carrierconfig-vendor.xml keeps the layout ElementTree produced for it after
+# an effbot-style indent() pass (4 spaces per level, " />" for empty elements),
+# but is written one carrier_config at a time instead of from a complete tree.
+
+
+def escape_attrib(value):
+    """Escape an attribute value like ElementTree does."""
+    return escape(value, {'"': "&quot;", "\r": "&#13;", "\n": "&#10;", "\t": "&#09;"})
+
+
+def xml_element(tag, attributes, level, children=(), text=None):
+    """Serialize an element whose already serialized children sit one level
+    deeper. The element's own indentation and tail are left to the caller."""
+    start = "<" + tag
+    for key, value in attributes:
+        start += f' {key}="{escape_attrib(value)}"'
+    if children:
+        i = "\n" + (level + 1) * "    "
+        return f"{start}>{''.join(i + c for c in children)}\n{level * '    '}</{tag}>"
+    if text:
+        return f"{start}>{escape(text)}</{tag}>"
+    return start + " />"
+
+
+def gen_config_tree(config, level, config_filter):
+    """Serialize a Config at the given nesting level, or return None if it is
+    filtered out by config_filter."""
+    if config_filter.drop_key(config.key):
+        return None
+    value_type = config.WhichOneof("value")
+    match value_type:
+        case "text_value":
+            if config_filter.drop_text(config.key, getattr(config, value_type)):
+                return None
+            return xml_element(
+                "string",
+                [("name", config.key)],
+                level,
+                text=getattr(config, value_type),
+            )
+        case "int_value":
+            return xml_element(
+                "int",
+                [("name", config.key), ("value", str(getattr(config, value_type)))],
+                level,
+            )
+        case "long_value":
+            return xml_element(
+                "long",
+                [("name", config.key), ("value", str(getattr(config, value_type)))],
+                level,
+            )
+        case "bool_value":
+            return xml_element(
+                "boolean",
+                [
+                    ("name", config.key),
+                    ("value", str(getattr(config, value_type)).lower()),
+                ],
+                level,
+            )
+        case "text_array":
+            items = getattr(config, value_type).item
+            filtered_items = config_filter.filter_items(config.key, items)
+            if filtered_items is not items:
+                items = filtered_items
+                # if there's only 1 value defined ("com.google.android.carriersetup") in
+                # the list, just return so we're not writing an array of 0 values
+                if len(items) == 0:
+                    return None
+            return xml_element(
+                "string-array",
+                [("name", config.key), ("num", str(len(items)))],
+                level,
+                [xml_element("item", [("value", value)], level + 1) for value in items],
+            )
+        case "int_array":
+            items = getattr(config, value_type).item
+            return xml_element(
+                "int-array",
+                [("name", config.key), ("num", str(len(items)))],
+                level,
+                [
+                    xml_element("item", [("value", str(value))], level + 1)
+                    for value in items
+                ],
+            )
+        case "bundle":
+            configs = getattr(config, value_type).config
+            sub_elements = (
+                gen_config_tree(c, level + 1, config_filter) for c in configs
+            )
+            return xml_element(
+                "pbundle_as_map",
+                [("name", config.key)],
+                level,
+                [sub_element for sub_element in sub_elements if sub_element],
+            )
+        case "double_value":
+            raise TypeError(f"Found Config value type: {value_type}")
+            return xml_element(
+                "double",
+                [("name", config.key), ("value", str(getattr(config, value_type)))],
+                level,
+            )
+        case _:
+            print(f"Unknown Config value type: {value_type}")
+            return None
+
+
+def carrier_config_attributes(carrier_id):
+    """Return the attributes of the carrier_config element of a CarrierId."""
+    mcc, mnc = carrier_id.mcc_mnc[:3], carrier_id.mcc_mnc[3:]
+    # workaround for converting wrongfully made no sim config to global defaults
+    # for device config
+    if (mcc, mnc) == ("000", "000"):
+        attributes = []
     else:
-        front = False
+        attributes = [("mcc", mcc), ("mnc", mnc)]
+    for field in ["spn", "imsi", "gid1"]:
+        if carrier_id.HasField(field):
+            attributes.append((field, getattr(carrier_id, field)))
+    return attributes
+
+
+def gen_config_elements(configs, config_filter):
+    """Serialize the configs of a carrier_config element, as a list of (key,
+    element) tuples."""
+    sub_elements = (
+        (config.key, gen_config_tree(config, 1, config_filter)) for config in configs
+    )
+    sub_elements = [sub_element for sub_element in sub_elements if sub_element[1]]
+    stats.counts["carrier_configs_rendered"] += 1
+    stats.counts["configs_rendered"] += len(sub_elements)
+    return sub_elements
+
+
+def gen_carrier_config(carrier_id, configs, tail, config_filter):
+    """Serialize the carrier_config element of a carrier_list entry."""
+    sub_elements = [
+        element for _, element in gen_config_elements(configs, config_filter)
+    ]
+    if sub_elements:
+        # Elements with children always end their line
+        tail = "\n"
+    return (
+        xml_element(
+            "carrier_config", carrier_config_attributes(carrier_id), 0, sub_elements
+        )
+        + tail
+    )
+
+
+def compact_carrier_configs(blocks):
+    """Drop the configs of an mccmnc group's carrier_config elements which do
+    not change what the CarrierConfig app loads for any SIM.
+
+    blocks is a list of (attributes, [(key, element)]) tuples in file order, and
+    a list of those which are left non-empty is returned. The app merges every
+    carrier_config whose attributes all match the SIM, in order, later values
+    replacing earlier ones. A config of a block B is redundant if every SIM
+    matching B already has it before B: walking back from B, each block setting
+    the key sets the same value, up to one whose attributes are a subset of B's
+    and so matches all of those SIMs. This drops configs repeating their
+    group's base and blocks duplicating earlier ones.
+
+    Only the kept blocks are considered for later blocks, so each decision holds
+    for the output actually written. Keys set more than once in a block are
+    always kept.
+    """
+    kept_blocks = []
+    # (attribute set, {key: element}) of kept_blocks
+    emitted = []
+    for attributes, sub_elements in blocks:
+        attribute_set = set(attributes)
+        key_counts = Counter(key for key, _ in sub_elements)
+        kept = []
+        for key, element in sub_elements:
+            redundant = False
+            if key_counts[key] == 1:
+                for earlier_attributes, values in reversed(emitted):
+                    if key not in values:
+                        continue
+                    if values[key] != element:
+                        break
+                    if earlier_attributes <= attribute_set:
+                        redundant = True
+                        break
+            if redundant:
+                stats.counts["compact_configs_dropped"] += 1
+            else:
+                kept.append((key, element))
+        if kept:
+            kept_blocks.append((attributes, kept))
+            emitted.append((attribute_set, dict(kept)))
+        else:
+            stats.counts["compact_blocks_dropped"] += 1
+    return kept_blocks
 
-    mccmnc_combo = (
-        "carrier_config_mccmnc_"
-        + lone_carrier_config.attrib["mcc"]
-        + lone_carrier_config.attrib["mnc"]
-        + ".xml"
+
+def format_apn_attributes(attributes):
+    return "".join(
+        "      {}={}\n".format(escape(key), quoteattr(value))
+        for key, value in attributes
     )
 
-    # handle multiple carrier configurations under the same mcc and mnc combination
-    if mccmnc_combo not in carrier_config_mccmnc_aggregated:
-        blank_list = []
-        carrier_config_mccmnc_aggregated[mccmnc_combo] = blank_list
-    temp_list = carrier_config_mccmnc_aggregated[mccmnc_combo]
-    if front is True:
-        temp_list.insert(0, lone_carrier_config)
+
+def gen_apn_parts(setting):
+    """Serialize the parts of the apn elements of a setting which do not depend
+    on the carrier_list entry, as (start, before MVNO, after MVNO) tuples."""
+    parts = []
+    for apn in setting.apns.apn:
+        before_mvno, after_mvno = apn_attributes(apn)
+        parts.append(
+            (
+                "  <apn carrier={}\n".format(quoteattr(apn.name)),
+                format_apn_attributes(before_mvno),
+                format_apn_attributes(after_mvno) + "  />\n\n",
+            )
+        )
+    return parts
+
+
+def gen_apns(entry, setting, carrier_id_matcher, rendered_apns=None):
+    """Serialize the apn elements of a carrier_list entry.
+
+    The parts of the apn elements which only depend on the setting are stored in
+    rendered_apns by id of the setting, if given, and reused for other entries
+    of the same setting.
+    """
+    carrier, mvno = carrier_attributes(entry.carrier_id[0], carrier_id_matcher)
+    carrier = format_apn_attributes(carrier)
+    mvno = format_apn_attributes(mvno)
+    if rendered_apns is None:
+        parts = gen_apn_parts(setting)
     else:
-        temp_list.append(lone_carrier_config)
-    carrier_config_mccmnc_aggregated[mccmnc_combo] = temp_list
+        # The setting is kept with its parts so that its id stays unique
+        _, parts = rendered_apns.setdefault(id(setting), (setting, None))
+        if parts is None:
+            parts = gen_apn_parts(setting)
+            rendered_apns[id(setting)] = (setting, parts)
+    stats.counts["apns_rendered"] += len(parts)
+    return "".join(
+        start + carrier + before + mvno + after for start, before, after in parts
+    )
+
+
+@stats.stage("render_apns")
+def render_apns(f, carrier_list, all_settings, carrier_id_matcher, cache=None):
+    """Write apns-conf.xml to the file object f.
+
+    Fragments are reused from cache, an ExtractionCache, if given.
+    """
+    f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n\n')
+    f.write('<apns version="8">\n\n')
+
+    rendered_apns = {}
+
+    def render(entry):
+        return gen_apns(
+            entry,
+            all_settings[entry.canonical_name],
+            carrier_id_matcher,
+            rendered_apns,
+        )
+
+    stats.counts["entries"] += len(carrier_list.entry)
+    for entry in carrier_list.entry:
+        f.write(
+            ExtractionCache.render_fragment(
+                cache, "apn", entry, carrier_id_matcher.digest, partial(render, entry)
+            )
+        )
+
+    f.write("</apns>\n")
+
+
+def aggregate_carrier_configs(carrier_list):
+    """Group carrier_list entries by the mccmnc file CarrierConfig looks them up
+    in.
+
+    Returns a dict of lists of (entry, tail) tuples. Within a group, entries
+    without MVNO data come first, in reverse order, then MVNO entries in order.
+    """
+    # dict containing lookups for each mccmnc combo representing each file,
+    # which contains the front entries and the MVNO entries of the file
+    carrier_config_mccmnc_aggregated = {}
+
+    last_index = len(carrier_list.entry) - 1
+    for index, entry in enumerate(carrier_list.entry):
+        carrier_id = entry.carrier_id[0]
+        # An empty carrier_config keeps the tail it had as a child of
+        # carrier_config_list, which only ends the line for the last entry
+        if index == last_index:
+            tail = "\n"
+        else:
+            tail = "\n    "
 
+        # append mnc to mcc to form identifier used to lookup carrier XML in
+        # CarrierConfig app
+        mccmnc_combo = "carrier_config_mccmnc_" + carrier_id.mcc_mnc + ".xml"
 
-with open(cc_out, "w", encoding="utf-8") as f:
+        # handle multiple carrier configurations under the same mcc and mnc
+        # combination
+        front, mvno = carrier_config_mccmnc_aggregated.setdefault(
+            mccmnc_combo, ([], [])
+        )
+        if (
+            (not carrier_id.HasField("gid1"))
+            and (not carrier_id.HasField("spn"))
+            and (not carrier_id.HasField("imsi"))
+        ):
+            front.append((entry, tail))
+        else:
+            mvno.append((entry, tail))
+
+    # Front entries used to be inserted at the start of their group one at a
+    # time, which put them in reverse order
+    return {
+        mccmnc_combo: front[::-1] + mvno
+        for mccmnc_combo, (front, mvno) in carrier_config_mccmnc_aggregated.items()
+    }
+
+
+@stats.stage("render_carrier_configs")
+def render_carrier_configs(
+    f,
+    carrier_list,
+    all_settings,
+    device,
+    cache=None,
+    config_filter=None,
+    compact=False,
+    jobs=1,
+):
+    """Write carrierconfig-vendor.xml for device to the file object f.
+
+    Configs are filtered by config_filter, by default the ConfigFilter compiled
+    from the shipped rules for device. Fragments are reused from cache, an
+    ExtractionCache, if given. With compact, configs which do not change what
+    any SIM loads are left out, see compact_carrier_configs().
+
+    With jobs > 1, the mccmnc groups are rendered by that many forked processes
+    where the platform supports fork, and written in order, so the output is
+    the same as with one job.
+    """
+    if config_filter is None:
+        config_filter = compile_config_filter(device)
+    groups = list(aggregate_carrier_configs(carrier_list).values())
     f.write('<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n')
     f.write("<carrier_config_list>\n")
-    for configfile in carrier_config_mccmnc_aggregated:
-        config_list = carrier_config_mccmnc_aggregated[configfile]
-        for config in config_list:
-            config_tree = ET.ElementTree(config)
-            config_tree = config_tree.getroot()
-            indent(config_tree)
-            single_carrier_config = ET.tostring(config_tree, encoding="unicode")
-            single_carrier_config = str(single_carrier_config)
-            # workaround for converting wrongfully made no sim config to global defaults
-            # for device config
-            single_carrier_config = single_carrier_config.replace(
-                ' mcc="000" mnc="000"', ""
-            )
-            f.write(single_carrier_config)
+    render = partial(
+        gen_carrier_config_group,
+        all_settings=all_settings,
+        cache=cache,
+        config_filter=config_filter,
+        compact=compact,
+    )
+    if jobs > 1 and len(groups) > 1:
+        f.writelines(render_in_processes(render, groups, jobs, cache, config_filter))
+    else:
+        f.writelines(map(render, groups))
     f.write("</carrier_config_list>\n")
-    f.close()
+
+
+def gen_carrier_config_group(config_list, all_settings, cache, config_filter, compact):
+    """Serialize the carrier_config elements of an mccmnc group."""
+    if compact:
+        return gen_compact_carrier_configs(
+            config_list, all_settings, cache, config_filter
+        )
+    fragments = []
+
+    def render(entry, tail):
+        return gen_carrier_config(
+            entry.carrier_id[0],
+            all_settings[entry.canonical_name].configs.config,
+            tail,
+            config_filter,
+        )
+
+    for entry, tail in config_list:
+        fragments.append(
+            ExtractionCache.render_fragment(
+                cache,
+                "carrier_config",
+                entry,
+                (config_filter.digest, tail),
+                partial(render, entry, tail),
+            )
+        )
+    return "".join(fragments)
+
+
+# Render function and groups of render_in_processes(), inherited by the forked
+# workers instead of being pickled
+_render_job = None
+
+
+def render_in_processes(render, groups, jobs, cache, config_filter):
+    """Yield render(group) for each of groups, computed by jobs forked processes.
+
+    The fragments cache used, the stats and the config_filter counts of the
+    workers are merged back into this process. Without fork, the groups are
+    rendered by this process.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    global _render_job
+    if "fork" not in multiprocessing.get_all_start_methods():
+        yield from map(render, groups)
+        return
+    # A few chunks per worker balance groups of different sizes
+    chunk_size = max(len(groups) // (jobs * 4), 1)
+    chunks = [
+        (start, min(start + chunk_size, len(groups)))
+        for start in range(0, len(groups), chunk_size)
+    ]
+    _render_job = render, groups, cache, config_filter
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            for text, worker_stats, counts, fragments in executor.map(
+                _render_chunk, *zip(*chunks)
+            ):
+                stats.merge(worker_stats)
+                config_filter.counts.update(counts)
+                if cache is not None:
+                    cache.used_fragments.update(fragments)
+                yield text
+    finally:
+        _render_job = None
+
+
+def _render_chunk(start, stop):
+    render, groups, cache, config_filter = _render_job
+    # Workers are reused, only report what this chunk added
+    stats.reset()
+    config_filter.counts.clear()
+    if cache is not None:
+        cache.used_fragments = {}
+    with stats.stage("render_carrier_configs_workers"):
+        text = "".join(map(render, groups[start:stop]))
+    fragments = None if cache is None else cache.used_fragments
+    return text, stats.as_dict(), config_filter.counts, fragments
+
+
+def gen_compact_carrier_configs(config_list, all_settings, cache, config_filter):
+    """Serialize the carrier_config elements of an mccmnc group, compacted."""
+    blocks = []
+    full_size = 0
+
+    def render(entry):
+        return gen_config_elements(
+            all_settings[entry.canonical_name].configs.config, config_filter
+        )
+
+    for entry, tail in config_list:
+        sub_elements = ExtractionCache.render_fragment(
+            cache,
+            "config_elements",
+            entry,
+            config_filter.digest,
+            partial(render, entry),
+        )
+        attributes = carrier_config_attributes(entry.carrier_id[0])
+        elements = [element for _, element in sub_elements]
+        full = xml_element("carrier_config", attributes, 0, elements)
+        full_size += len((full + ("\n" if elements else tail)).encode())
+        blocks.append((attributes, sub_elements))
+    compacted = "".join(
+        xml_element(
+            "carrier_config",
+            attributes,
+            0,
+            [element for _, element in sub_elements],
+        )
+        + "\n"
+        for attributes, sub_elements in compact_carrier_configs(blocks)
+    )
+    stats.counts["compact_bytes_before"] += full_size
+    stats.counts["compact_bytes_after"] += len(compacted.encode())
+    return compacted
+
+
+@contextmanager
+def atomic_output(filename, check=None):
+    """Open filename for writing, replacing it only once the block completes so
+    that a failed extraction never leaves a truncated file behind.
+
+    check, if given, is called with the name of the written temporary file
+    before it replaces filename, and may raise to keep it from doing so.
+    """
+    temp = filename + ".tmp"
+    try:
+        with open(temp, "w", encoding="utf-8") as f:
+            yield f
+        if check is not None:
+            check(temp)
+    except BaseException:
+        os.remove(temp)
+        raise
+    os.replace(temp, filename)
+
+
+def copy_output(src, dst):
+    """Copy an output file, replacing dst atomically."""
+    temp = dst + ".tmp"
+    shutil.copyfile(src, temp)
+    os.replace(temp, dst)
+
+
+java_integer = re.compile(r"[-+]?[0-9]+")
+
+
+def is_java_int(value):
+    """Return whether Integer.parseInt accepts value."""
+    return (
+        java_integer.fullmatch(value) is not None
+        and -0x80000000 <= int(value) <= 0x7FFFFFFF
+    )
+
+
+def is_java_long(value):
+    """Return whether Long.parseLong accepts value."""
+    return (
+        java_integer.fullmatch(value) is not None
+        and -0x8000000000000000 <= int(value) <= 0x7FFFFFFFFFFFFFFF
+    )
+
+
+def is_java_double(value):
+    """Return whether Double.parseDouble accepts value, near enough."""
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def is_bool(value):
+    return value in ("true", "false")
+
+
+def is_digits(*lengths):
+    return lambda value: len(value) in lengths and value.isdigit()
+
+
+apn_protocols = {"IP", "IPV6", "IPV4V6", "PPP", "NON-IP", "UNSTRUCTURED"}
+
+# What TelephonyProvider reads from apn attributes, by attribute name, as a
+# check of the value or None for strings. Other attributes are ignored
+apn_attribute_checks = {
+    "carrier": None,
+    "carrier_id": is_java_int,
+    "mcc": is_digits(3),
+    "mnc": is_digits(2, 3),
+    "apn": None,
+    "proxy": None,
+    "port": None,
+    "mmsc": None,
+    "mmsproxy": None,
+    "mmsport": None,
+    "user": None,
+    "password": None,
+    "server": None,
+    "authtype": is_java_int,
+    "type": None,
+    "protocol": apn_protocols.__contains__,
+    "roaming_protocol": apn_protocols.__contains__,
+    "bearer_bitmask": None,
+    "profile_id": is_java_int,
+    "modem_cognitive": is_bool,
+    "max_conns": is_java_int,
+    "wait_time": is_java_int,
+    "max_conns_time": is_java_int,
+    "mtu": is_java_int,
+    "mvno_type": {"spn", "imsi", "gid", "iccid", "pnn"}.__contains__,
+    "mvno_match_data": None,
+    "apn_set_id": is_java_int,
+    "skip_464xlat": is_java_int,
+    "user_visible": is_bool,
+    "user_editable": is_bool,
+}
+
+# Attributes of the carrier_config elements the CarrierConfig app matches SIMs
+# against
+carrier_config_attribute_names = {
+    "mcc",
+    "mnc",
+    "spn",
+    "imsi",
+    "gid1",
+    "gid2",
+    "cid",
+    "name",
+    "device",
+}
+
+# Checks of the values of the PersistableBundle elements the CarrierConfig app
+# reads, by tag
+config_value_checks = {
+    "int": is_java_int,
+    "long": is_java_long,
+    "boolean": is_bool,
+    "double": is_java_double,
+}
+config_array_checks = {
+    "string-array": None,
+    "int-array": is_java_int,
+    "long-array": is_java_long,
+    "double-array": is_java_double,
+    "boolean-array": is_bool,
+}
+
+
+def parse_xml(filename, start, end, text):
+    """Stream an XML file through expat, calling start(tag, attributes),
+    end(tag) and text(data) as it goes.
+
+    The file is fed in blocks, so memory stays bounded whatever its size, and
+    no tree is built. Raises ValueError, with the line it was found at, if the
+    file is not well-formed or a handler raises ValueError.
+    """
+    where = os.path.basename(filename)
+    parser = expat.ParserCreate()
+    # Runs of text are passed in one call
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text
+    try:
+        with open(filename, "rb") as f:
+            while True:
+                data = f.read(1 << 20)
+                parser.Parse(data, not data)
+                if not data:
+                    break
+    except expat.ExpatError as e:
+        raise ValueError(
+            f"{where}:{e.lineno}: {expat.errors.messages[e.code]}"
+        ) from None
+    except ValueError as e:
+        raise ValueError(f"{where}:{parser.CurrentLineNumber}: {e}") from None
+
+
+@stats.stage("verify_apns")
+def verify_apns(filename, carrier_list, all_settings):
+    """Check an apns-conf.xml written by render_apns() by streaming it back.
+
+    Every apn must only have attributes TelephonyProvider accepts, and the apns
+    must be those of the entries of carrier_list, in order. Raises ValueError
+    otherwise.
+    """
+    expected = (
+        (entry, apn)
+        for entry in carrier_list.entry
+        for apn in all_settings[entry.canonical_name].apns.apn
+    )
+    missing = object()
+    # Tags of the open elements
+    stack = []
+    count = 0
+
+    def start(tag, attributes):
+        nonlocal count
+        depth = len(stack)
+        stack.append(tag)
+        if depth == 1 and tag == "apn":
+            count += 1
+            name = attributes.get("carrier")
+            for key, value in attributes.items():
+                check = apn_attribute_checks.get(key, missing)
+                if check is None:
+                    continue
+                if check is missing or not check(value):
+                    raise ValueError(f"apn #{count} ({name}): invalid {key}={value!r}")
+            entry, apn = next(expected, (None, None))
+            if entry is None:
+                raise ValueError(f"apn #{count} ({name}): not in the inputs")
+            if name != apn.name or (
+                attributes.get("mcc", "") + attributes.get("mnc", "")
+                != entry.carrier_id[0].mcc_mnc
+            ):
+                raise ValueError(
+                    f"apn #{count} ({name}): expected {apn.name} of"
+                    f" {entry.canonical_name}"
+                )
+        elif depth == 0 and tag == "apns":
+            if attributes != {"version": "8"}:
+                raise ValueError(f"apns has {attributes}")
+        else:
+            raise ValueError(f"unexpected {tag} element")
+
+    def end(tag):
+        del stack[-1]
+
+    def text(data):
+        if not data.isspace():
+            raise ValueError(f"unexpected text {data.strip()!r}")
+
+    parse_xml(filename, start, end, text)
+    if next(expected, None) is not None:
+        raise ValueError(
+            f"{os.path.basename(filename)}: {count} apns, fewer than in the inputs"
+        )
+    stats.counts["apns_verified"] += count
+
+
+# Elements whose children are config elements
+config_parents = {"carrier_config", "pbundle_as_map"}
+
+
+@stats.stage("verify_carrier_configs")
+def verify_carrier_configs(filename, carrier_list, compact=False):
+    """Check a carrierconfig-vendor.xml written by render_carrier_configs() by
+    streaming it back.
+
+    Every config must be an element the CarrierConfig app reads, with a valid
+    value, and the carrier_config elements those of the entries of
+    carrier_list, in order. With compact, carrier_config elements left empty
+    may be missing. Raises ValueError otherwise.
+    """
+    expected = (
+        carrier_config_attributes(entry.carrier_id[0])
+        for config_list in aggregate_carrier_configs(carrier_list).values()
+        for entry, _ in config_list
+    )
+    # Tags of the open elements, and (item check, num, item values) of open
+    # arrays
+    stack = [None]
+    arrays = []
+    count = 0
+    # Configs of the current carrier_config, and of all of them
+    configs = 0
+    total_configs = 0
+
+    def start(tag, attributes):
+        nonlocal count, configs
+        parent = stack[-1]
+        stack.append(tag)
+        if tag == "item":
+            if len(attributes) != 1 or parent not in config_array_checks:
+                raise ValueError(f"invalid item {attributes} in {parent}")
+            # Checked once the array is closed
+            arrays[-1][2].append(attributes.get("value"))
+        elif parent in config_parents:
+            if parent == "carrier_config":
+                configs += 1
+            name = attributes.get("name")
+            check = config_value_checks.get(tag)
+            if check is not None:
+                if (
+                    len(attributes) != 2
+                    or name is None
+                    or not check(attributes.get("value", ""))
+                ):
+                    raise ValueError(f"invalid {tag} {attributes}")
+            elif tag == "string" or tag == "pbundle_as_map":
+                if len(attributes) != 1 or name is None:
+                    raise ValueError(f"invalid {tag} {attributes}")
+            elif tag in config_array_checks:
+                if len(attributes) != 2 or name is None or "num" not in attributes:
+                    raise ValueError(f"invalid {tag} {attributes}")
+                arrays.append((config_array_checks[tag], attributes["num"], []))
+            else:
+                raise ValueError(f"unknown {tag} element in {parent}")
+        elif tag == "carrier_config" and parent == "carrier_config_list":
+            count += 1
+            configs = 0
+            items = list(attributes.items())
+            for expected_attributes in expected:
+                if items == expected_attributes or not compact:
+                    break
+            else:
+                expected_attributes = None
+            if items != expected_attributes:
+                raise ValueError(
+                    f"carrier_config #{count} {attributes} instead of"
+                    f" {dict(expected_attributes or [])}"
+                )
+            for key in attributes:
+                if key not in carrier_config_attribute_names:
+                    raise ValueError(
+                        f"carrier_config #{count}: unknown attribute {key}"
+                    )
+        elif tag == "carrier_config_list" and parent is None:
+            if attributes:
+                raise ValueError(f"carrier_config_list has {attributes}")
+        else:
+            raise ValueError(f"unexpected {tag} element in {parent}")
+
+    def end(tag):
+        nonlocal total_configs
+        del stack[-1]
+        if tag in config_array_checks:
+            check, num, values = arrays.pop()
+            if num != str(len(values)):
+                raise ValueError(f"{tag} num is {num} for {len(values)} items")
+            if None in values or (check is not None and not all(map(check, values))):
+                value = next(
+                    v
+                    for v in values
+                    if v is None or (check is not None and not check(v))
+                )
+                raise ValueError(f"invalid {tag} item {value!r}")
+        elif tag == "carrier_config":
+            if compact and not configs:
+                raise ValueError(f"carrier_config #{count} is empty")
+            total_configs += configs
+
+    def text(data):
+        if not data.isspace() and stack[-1] != "string":
+            raise ValueError(f"unexpected text {data.strip()!r} in {stack[-1]}")
+
+    parse_xml(filename, start, end, text)
+    if not compact and next(expected, None) is not None:
+        raise ValueError(
+            f"{os.path.basename(filename)}: {count} carrier_configs, fewer than"
+            " entries"
+        )
+    stats.counts["carrier_configs_verified"] += count
+    stats.counts["configs_verified"] += total_configs
+
+
+def extract(
+    pb_path,
+    carrier_id_matcher,
+    outputs,
+    jobs=1,
+    cache_dir=None,
+    config_rules=None,
+    snapshot=None,
+    compact=False,
+    verify=False,
+):
+    """Generate the XMLs of one CarrierSettings directory.
+
+    outputs is a list of (apn_out, cc_out, device) tuples of devices shipping
+    this directory. apns-conf.xml is the same for all of them and is only
+    rendered once, carrierconfig-vendor.xml once per distinct device filter.
+    Configs are filtered with the rules of the config_rules file, by default
+    the shipped unwanted_configs.txt.
+
+    With a cache_dir, only the entries whose inputs changed since the previous
+    extraction using it are rendered again. With a snapshot file, the inputs
+    are read from it instead, see load_snapshot(). With compact, redundant
+    configs are left out of carrierconfig-vendor.xml.
+
+    Outputs are replaced atomically once written. With verify, each XML is read
+    back and checked against the inputs first, see verify_apns() and
+    verify_carrier_configs(), raising ValueError and leaving the previous file
+    in place if it is invalid.
+
+    jobs processes render carrier configs.
+
+    Returns the ConfigFilter used for each device.
+    """
+    config_filters = {
+        device: compile_config_filter(device, config_rules) for _, _, device in outputs
+    }
+    # Filters are shared between extractions of this process, only report what
+    # they dropped in this one
+    for config_filter in config_filters.values():
+        config_filter.counts.clear()
+    source = settings_source(pb_path)
+    if snapshot is not None:
+        snapshot = load_snapshot(snapshot, source, carrier_id_matcher)
+        carrier_list, all_settings = snapshot.carrier_list, snapshot.settings
+        carrier_id_matcher = snapshot.carrier_ids
+    if cache_dir is None:
+        cache = None
+        if snapshot is None:
+            carrier_list, all_settings = load_settings(source)
+    else:
+        filter_digests = sorted({f.digest for f in config_filters.values()})
+        cache = ExtractionCache(
+            cache_dir,
+            hashlib.sha256(repr((source.path, filter_digests)).encode()).hexdigest(),
+        )
+        if snapshot is None:
+            carrier_list, all_settings = load_settings_incremental(source, cache)
+        else:
+            # Fragments are keyed by the hash of the serialized setting instead
+            # of the file it came from
+            cache.setting_digests.update(snapshot.setting_digests)
+    rendered = {}
+    for apn_out, cc_out, device in outputs:
+        if "apn" in rendered:
+            copy_output(rendered["apn"], apn_out)
+        else:
+            check = None
+            if verify:
+                check = partial(
+                    verify_apns, carrier_list=carrier_list, all_settings=all_settings
+                )
+            with atomic_output(apn_out, check) as f:
+                render_apns(f, carrier_list, all_settings, carrier_id_matcher, cache)
+            rendered["apn"] = apn_out
+        config_filter = config_filters[device]
+        cc_key = ("cc", config_filter.digest)
+        if cc_key in rendered:
+            copy_output(rendered[cc_key], cc_out)
+        else:
+            check = None
+            if verify:
+                check = partial(
+                    verify_carrier_configs, carrier_list=carrier_list, compact=compact
+                )
+            with atomic_output(cc_out, check) as f:
+                render_carrier_configs(
+                    f,
+                    carrier_list,
+                    all_settings,
+                    device,
+                    cache,
+                    config_filter,
+                    compact,
+                    jobs,
+                )
+            rendered[cc_key] = cc_out
+    if cache is not None:
+        cache.save()
+    return config_filters
+
+
+def print_filter_report(config_filters, file=sys.stderr):
+    """Print how many configs each rule dropped, per device."""
+    reported = set()
+    for device, config_filter in config_filters.items():
+        if id(config_filter) in reported:
+            continue
+        reported.add(id(config_filter))
+        devices = [d for d, f in config_filters.items() if f is config_filter]
+        print(f"Configs dropped for {', '.join(devices)}:", file=file)
+        for rule, count in config_filter.counts.most_common():
+            print(f"{count:8}  {rule}", file=file)
+
+
+def print_compaction_report(file=sys.stderr):
+    """Print how much smaller compaction made the carrier_config elements."""
+    before = stats.counts["compact_bytes_before"]
+    after = stats.counts["compact_bytes_after"]
+    saved = 100 * (before - after) / before if before else 0
+    print(
+        f"Compacted carrier_config elements from {before} to {after} bytes"
+        f" (-{saved:.1f}%), dropping {stats.counts['compact_configs_dropped']}"
+        f" configs and {stats.counts['compact_blocks_dropped']} elements",
+        file=file,
+    )
+
+
+def write_stats_json(filename, config_filters, tracemalloc_peak=None):
+    """Write the stats of this extraction as JSON to filename, or stdout for "-"."""
+    report = stats.as_dict()
+    report["filtered"] = {
+        device: dict(config_filter.counts)
+        for device, config_filter in config_filters.items()
+    }
+    if tracemalloc_peak is not None:
+        report["tracemalloc_peak_bytes"] = tracemalloc_peak
+    if filename == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+def instrumented(args, run):
+    """Call run() under the instrumentation requested by the --profile,
+    --tracemalloc and --stats-json options, returning its config filters."""
+    tracemalloc_peak = None
+    if args.tracemalloc:
+        import tracemalloc
+
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        config_filters = run()
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.tracemalloc:
+            tracemalloc.take_snapshot().dump(args.tracemalloc)
+            tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    if args.stats_json:
+        write_stats_json(args.stats_json, config_filters, tracemalloc_peak)
+    return config_filters
+
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="write time per stage, counts and peak memory as JSON (- for stdout)",
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE", help="write cProfile stats of this process"
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        metavar="FILE",
+        help="write a tracemalloc snapshot of this process",
+    )
+
+
+def read_manifest(manifest):
+    """Read a batch manifest.
+
+    Each non-empty line that is not a # comment holds the CarrierSettings
+    directory, apns-conf.xml path, carrierconfig-vendor.xml path and codename of
+    one device, separated by whitespace. A codename may only be listed once,
+    as results like the filter report are by codename.
+    """
+    devices = []
+    # Line numbers by codename
+    listed = {}
+    with open(manifest, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) != 4:
+                raise ValueError(
+                    f"{manifest}:{line_number}: expected 4 fields, got {len(fields)}"
+                )
+            device = fields[3]
+            if device in listed:
+                raise ValueError(
+                    f"{manifest}:{line_number}: {device} already listed on line"
+                    f" {listed[device]}"
+                )
+            listed[device] = line_number
+            devices.append(tuple(fields))
+    return devices
+
+
+def _init_batch_worker(carrier_id_matcher):
+    global _batch_carrier_id_matcher
+    _batch_carrier_id_matcher = carrier_id_matcher
+
+
+def snapshot_filename(snapshot_dir, pb_path):
+    """Return the file in snapshot_dir holding the snapshot of pb_path."""
+    path = settings_source(pb_path).path
+    return os.path.join(
+        snapshot_dir, hashlib.sha256(path.encode()).hexdigest() + ".snapshot"
+    )
+
+
+def _extract_batch_group(
+    pb_path, outputs, cache_dir, config_rules, snapshot_dir, compact, verify
+):
+    # Workers are reused, only report the stats of this group
+    stats.reset()
+    snapshot = None
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshot = snapshot_filename(snapshot_dir, pb_path)
+    config_filters = extract(
+        pb_path,
+        _batch_carrier_id_matcher,
+        outputs,
+        cache_dir=cache_dir,
+        config_rules=config_rules,
+        snapshot=snapshot,
+        compact=compact,
+        verify=verify,
+    )
+    return config_filters, stats.as_dict()
+
+
+def batch(
+    manifest,
+    android_build_top,
+    jobs=1,
+    cache_dir=None,
+    config_rules=None,
+    snapshot_dir=None,
+    compact=False,
+    verify=False,
+):
+    """Generate the XMLs of every device listed in a manifest.
+
+    The carrier_id database is loaded once and devices shipping identical
+    CarrierSettings directories share one extraction. With a snapshot_dir, each
+    extraction reads its inputs from a snapshot file kept in it.
+
+    Returns the ConfigFilter used for each device. The stats of the workers are
+    added to stats.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    carrier_id_matcher = load_carrier_ids(android_build_top)
+    if snapshot_dir is None:
+        # Parsed and indexed once here, rather than in every worker. Workers
+        # reading snapshots only need it for those which must be rewritten.
+        carrier_id_matcher.index
+    groups = {}
+    for pb_path, apn_out, cc_out, device in read_manifest(manifest):
+        group = groups.setdefault(settings_digest(pb_path), (pb_path, []))
+        group[1].append((apn_out, cc_out, device))
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_batch_worker,
+        initargs=(carrier_id_matcher,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _extract_batch_group,
+                pb_path,
+                outputs,
+                cache_dir,
+                config_rules,
+                snapshot_dir,
+                compact,
+                verify,
+            )
+            for pb_path, outputs in groups.values()
+        ]
+        config_filters = {}
+        for future in futures:
+            group_filters, group_stats = future.result()
+            config_filters.update(group_filters)
+            stats.merge(group_stats)
+    return config_filters
+
+
+def load_settings_lazily(path):
+    """Load a snapshot, or a CarrierSettings directory or archive, without
+    decoding any setting.
+
+    Returns the CarrierList, a LazySettings, and a function returning the hash
+    of the encoded setting of a canonical name, or None if there is none.
+    """
+    from carrier_list_pb2 import CarrierList
+
+    if os.path.isfile(path):
+        try:
+            snapshot = Snapshot(path)
+        except ValueError:
+            pass
+        else:
+            return (
+                snapshot.carrier_list,
+                snapshot.settings,
+                snapshot.setting_digests.get,
+            )
+    source = settings_source(path)
+    encoded = encoded_settings(source)
+    settings = LazySettings()
+    for canonical_name, data in encoded.items():
+        settings.add(canonical_name, partial(decode_setting, data))
+
+    def digest(canonical_name):
+        data = encoded.get(canonical_name)
+        return None if data is None else hashlib.sha256(data).hexdigest()
+
+    carrier_list = parse_input(CarrierList(), source, "carrier_list.pb")
+    return carrier_list, settings, digest
+
+
+def carrier_ids_by_name(carrier_list):
+    """Return the CarrierIds of each canonical name of a carrier_list, as
+    sorted lists of dicts of their fields."""
+    carrier_ids = {}
+    for entry in carrier_list.entry:
+        for carrier_id in entry.carrier_id:
+            carrier_ids.setdefault(entry.canonical_name, []).append(
+                {field.name: value for field, value in carrier_id.ListFields()}
+            )
+    for values in carrier_ids.values():
+        values.sort(key=lambda value: sorted(value.items()))
+    return carrier_ids
+
+
+def config_value(config):
+    """Return the value of a Config as JSON compatible data."""
+    value_type = config.WhichOneof("value")
+    match value_type:
+        case None:
+            return None
+        case "text_array" | "int_array":
+            return list(getattr(config, value_type).item)
+        case "bundle":
+            return {c.key: config_value(c) for c in config.bundle.config}
+        case _:
+            return getattr(config, value_type)
+
+
+def apn_values(setting):
+    """Return the apn attributes of a setting by APN name, with a #n suffix for
+    repeated names."""
+    apns = {}
+    for apn in setting.apns.apn:
+        key = apn.name
+        n = 1
+        while key in apns:
+            n += 1
+            key = f"{apn.name}#{n}"
+        before_mvno, after_mvno = apn_attributes(apn)
+        apns[key] = dict(before_mvno + after_mvno)
+    return apns
+
+
+def diff_dicts(old, new, compare=None):
+    """Return the added, removed and changed items of two dicts, leaving out
+    empty parts. compare(old, new) describes a change, by default [old, new]."""
+    if compare is None:
+
+        def compare(old_value, new_value):
+            return [old_value, new_value]
+
+    result = {}
+    added = {key: new[key] for key in new if key not in old}
+    removed = {key: old[key] for key in old if key not in new}
+    changed = {
+        key: compare(old[key], new[key])
+        for key in old
+        if key in new and old[key] != new[key]
+    }
+    for part, values in [("added", added), ("removed", removed), ("changed", changed)]:
+        if values:
+            result[part] = values
+    return result
+
+
+def diff_settings(old_path, new_path):
+    """Compare two CarrierSettings drops carrier by carrier.
+
+    Only carriers listed in either carrier_list are compared. Settings whose
+    encoded bytes hash the same are skipped without being decoded, the others
+    are compared by APN attributes and by config key.
+
+    Returns the differences as JSON compatible data, without the parts which
+    did not change.
+    """
+    old_list, old_settings, old_digest = load_settings_lazily(old_path)
+    new_list, new_settings, new_digest = load_settings_lazily(new_path)
+    old_ids = carrier_ids_by_name(old_list)
+    new_ids = carrier_ids_by_name(new_list)
+
+    report = {
+        "added": sorted(name for name in new_ids if name not in old_ids),
+        "removed": sorted(name for name in old_ids if name not in new_ids),
+        "changed": {},
+        "unchanged": 0,
+    }
+    for canonical_name in sorted(name for name in old_ids if name in new_ids):
+        changes = {}
+        if old_ids[canonical_name] != new_ids[canonical_name]:
+            changes["carrier_id"] = [old_ids[canonical_name], new_ids[canonical_name]]
+        if old_digest(canonical_name) != new_digest(canonical_name):
+            stats.counts["diff_settings_decoded"] += 1
+            old = old_settings[canonical_name]
+            new = new_settings[canonical_name]
+            apns = diff_dicts(
+                apn_values(old), apn_values(new), lambda o, n: diff_dicts(o, n)
+            )
+            if apns:
+                changes["apns"] = apns
+            configs = diff_dicts(
+                {config.key: config_value(config) for config in old.configs.config},
+                {config.key: config_value(config) for config in new.configs.config},
+            )
+            if configs:
+                changes["configs"] = configs
+        if changes:
+            report["changed"][canonical_name] = changes
+        else:
+            report["unchanged"] += 1
+    return report
+
+
+def print_diff(report, file=sys.stdout):
+    """Print a diff_settings() report as text."""
+
+    def show(value):
+        return json.dumps(value, ensure_ascii=False)
+
+    def print_items(indent, label, changes):
+        for key, value in changes.get("added", {}).items():
+            print(f"{indent}+ {label}{key} {show(value)}", file=file)
+        for key, value in changes.get("removed", {}).items():
+            print(f"{indent}- {label}{key} {show(value)}", file=file)
+
+    for canonical_name in report["added"]:
+        print(f"+ {canonical_name}", file=file)
+    for canonical_name in report["removed"]:
+        print(f"- {canonical_name}", file=file)
+    for canonical_name, changes in report["changed"].items():
+        print(f"~ {canonical_name}", file=file)
+        if "carrier_id" in changes:
+            old, new = changes["carrier_id"]
+            print(f"    ~ carrier_id {show(old)} -> {show(new)}", file=file)
+        apns = changes.get("apns", {})
+        print_items("    ", "apn ", apns)
+        for key, attributes in apns.get("changed", {}).items():
+            print(f"    ~ apn {key}", file=file)
+            print_items("        ", "", attributes)
+            for attribute, (old, new) in attributes.get("changed", {}).items():
+                print(f"        ~ {attribute} {show(old)} -> {show(new)}", file=file)
+        configs = changes.get("configs", {})
+        print_items("    ", "config ", configs)
+        for key, (old, new) in configs.get("changed", {}).items():
+            print(f"    ~ config {key} {show(old)} -> {show(new)}", file=file)
+    print(
+        f"{len(report['added'])} added, {len(report['removed'])} removed,"
+        f" {len(report['changed'])} changed, {report['unchanged']} unchanged",
+        file=file,
+    )
+
+
+def sim_matches(carrier_id, mcc_mnc, spn=None, imsi=None, gid1=None):
+    """Return whether the CarrierConfig app applies the carrier_config of a
+    CarrierId to a SIM.
+
+    Every attribute of the element must match the SIM's: mcc and mnc exactly,
+    gid1 ignoring case, imsi as a regular expression matching the whole IMSI
+    and spn as one matching the whole SPN, ignoring case. An element without
+    attributes, like those of 000000 entries, applies to every SIM.
+    """
+    for key, value in carrier_config_attributes(carrier_id):
+        try:
+            match key:
+                case "mcc":
+                    matches = mcc_mnc[:3] == value
+                case "mnc":
+                    matches = mcc_mnc[3:] == value
+                case "gid1":
+                    matches = gid1 is not None and gid1.lower() == value.lower()
+                case "imsi":
+                    matches = imsi is not None and re.fullmatch(value, imsi)
+                case "spn":
+                    matches = spn is not None and re.fullmatch(
+                        value, spn, re.IGNORECASE
+                    )
+        except re.error:
+            # Not a valid pattern, so matches nothing
+            matches = False
+        if not matches:
+            return False
+    return True
+
+
+def query(
+    carrier_list,
+    all_settings,
+    carrier_id_matcher,
+    config_filter,
+    mcc_mnc=None,
+    spn=None,
+    imsi=None,
+    gid1=None,
+    canonical_name=None,
+):
+    """Return what the generated XMLs hold for the carriers matching a SIM.
+
+    Entries are kept if the CarrierConfig app applies their carrier_config
+    element to a SIM with mcc_mnc, spn, imsi and gid1, see sim_matches(), which
+    includes the elements of 000000 entries matching any mccmnc, or by
+    canonical_name. Only their settings are decoded.
+
+    Returns a list with the canonical name, CarrierId, apn attributes and
+    carrier_config elements by key of each matching entry, in the order of
+    carrierconfig-vendor.xml, the configs a SIM ends up with when the
+    CarrierConfig app merges those elements in that order, and for a SIM, the
+    carrier_id CarrierResolver gives it (None if it matches no attribute).
+    """
+    # Entries in the order of carrierconfig-vendor.xml
+    entries = [
+        entry
+        for config_list in aggregate_carrier_configs(carrier_list).values()
+        for entry, _ in config_list
+    ]
+    if canonical_name is not None:
+        entries = [entry for entry in entries if entry.canonical_name == canonical_name]
+    else:
+        entries = [
+            entry
+            for entry in entries
+            if sim_matches(entry.carrier_id[0], mcc_mnc, spn, imsi, gid1)
+        ]
+
+    carriers = []
+    merged_configs = {}
+    for entry in entries:
+        carrier_id = entry.carrier_id[0]
+        setting = all_settings[entry.canonical_name]
+        apns = []
+        for apn in setting.apns.apn:
+            attributes = OrderedDict(carrier=apn.name)
+            attributes.update(
+                ApnElement(apn, carrier_id, carrier_id_matcher).attributes
+            )
+            apns.append(attributes)
+        configs = dict(gen_config_elements(setting.configs.config, config_filter))
+        merged_configs.update(configs)
+        carriers.append(
+            {
+                "canonical_name": entry.canonical_name,
+                "carrier_id": {
+                    field.name: value for field, value in carrier_id.ListFields()
+                },
+                "apns": apns,
+                "configs": configs,
+            }
+        )
+    result = {"carriers": carriers, "merged_configs": merged_configs}
+    if canonical_name is None:
+        result["carrier_id"] = carrier_id_matcher.match(
+            mcc_mnc, imsi or "", spn or "", gid1 or ""
+        )
+    return result
+
+
+def print_query(result, file=sys.stdout):
+    """Print a query() result as text."""
+    if "carrier_id" in result:
+        print(f"carrier_id: {result['carrier_id']}", file=file)
+    for carrier in result["carriers"]:
+        carrier_id = " ".join(f"{k}={v}" for k, v in carrier["carrier_id"].items())
+        print(f"{carrier['canonical_name']} ({carrier_id})", file=file)
+        for attributes in carrier["apns"]:
+            print(
+                "  <apn "
+                + " ".join(f"{escape(k)}={quoteattr(v)}" for k, v in attributes.items())
+                + " />",
+                file=file,
+            )
+        for element in carrier["configs"].values():
+            print("  " + element, file=file)
+    if result["carriers"]:
+        print("Merged configs:", file=file)
+        for element in result["merged_configs"].values():
+            print("  " + element, file=file)
+    else:
+        print("No matching carrier", file=file)
+
+
+def run_extraction(args):
+    """Run the extraction of the command line args."""
+    config_filters = instrumented(
+        args,
+        lambda: extract(
+            args.pb_path,
+            load_carrier_ids(args.android_build_top),
+            [(args.apn_out, args.cc_out, args.device)],
+            args.jobs,
+            args.cache_dir,
+            args.config_rules,
+            args.snapshot,
+            args.compact,
+            args.verify,
+        ),
+    )
+    # The defaults of these are bound to the real stderr, not a redirected one
+    if args.filter_report:
+        print_filter_report(config_filters, sys.stderr)
+    if args.compact:
+        print_compaction_report(sys.stderr)
+
+
+def file_stat(filename):
+    """Return the mtime in ns and size of a file, or None if it is missing."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def extraction_inputs(args):
+    """Return a value which changes whenever the inputs of the extraction of
+    the command line args may have changed.
+
+    This is polled, so archives are only stat()ed rather than opened through
+    settings_source(), which would list and maybe decompress them.
+    """
+    pb_path = args.pb_path
+    if os.path.isdir(pb_path):
+        try:
+            source_signature = DirectorySource(pb_path).signature()
+        except OSError:
+            source_signature = None
+    elif os.path.isfile(pb_path):
+        source_signature = file_stat(pb_path)
+    else:
+        source_signature = file_stat(pb_path.rpartition("!")[0])
+    return (
+        source_signature,
+        file_stat(
+            os.path.join(
+                args.android_build_top, android_path_to_carrierid, "carrier_list.pb"
+            )
+        ),
+        file_stat(
+            args.config_rules
+            or os.path.join(os.path.dirname(__file__), "unwanted_configs.txt")
+        ),
+    )
+
+
+class ExtractionServer:
+    """Extract XMLs for clients connecting to a Unix socket, see
+    request_extraction().
+
+    A request is the command line of an extraction and the directory it is run
+    from. Loaded inputs are kept between requests, see load_settings(), so an
+    extraction only parses what changed since the previous one. A request whose
+    inputs and outputs are unchanged since it was last served is answered
+    without extracting again. The inputs of every served request are polled,
+    and its outputs extracted again as soon as they change, so that the next
+    build finds them ready.
+
+    Extractions run one at a time in this process, with the output they print
+    returned to the client.
+    """
+
+    def __init__(self, socket_path, parser, interval=1.0):
+        self.socket_path = socket_path
+        self.parser = parser
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Served extractions by (directory, command line), as (args, inputs,
+        # outputs, response) lists
+        self.extractions = {}
+
+    def run(self):
+        """Serve requests until interrupted."""
+        import signal
+        import socket
+        import socketserver
+
+        global _keep_mappings
+        # Loaded inputs are kept between requests, but not the mappings of
+        # others.pb and archives they were read from
+        _keep_mappings = False
+        server_self = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                response = server_self.serve(request["cwd"], request["argv"])
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        # A socket left behind by a server which is gone is replaced
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX) as client:
+                try:
+                    client.connect(self.socket_path)
+                except OSError:
+                    os.remove(self.socket_path)
+                else:
+                    raise OSError(f"{self.socket_path}: a server is already running")
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        # Stopping with SIGTERM removes the socket too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        with socketserver.UnixStreamServer(self.socket_path, Handler) as server:
+            watcher.start()
+            print(f"Serving extractions on {self.socket_path}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(self.socket_path)
+
+    def serve(self, cwd, argv):
+        """Return the response to a request, extracting if needed."""
+        key = (cwd, tuple(argv))
+        with self.lock, working_directory(cwd):
+            extraction = self.extractions.get(key)
+            if extraction is not None:
+                args, inputs, outputs, response = extraction
+                if extraction_inputs(args) == inputs and self.outputs(args) == outputs:
+                    return response
+            return self.extract(key, argv)
+
+    def extract(self, key, argv):
+        """Run an extraction, remembering it if it succeeds, and return the
+        response to send for it."""
+        out, err = io.StringIO(), io.StringIO()
+        status = 0
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                args = self.parser.parse_args(argv)
+                inputs = extraction_inputs(args)
+                stats.reset()
+                run_extraction(args)
+            except SystemExit as e:
+                # Usage errors
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        response = {
+            "status": status,
+            "stdout": out.getvalue(),
+            "stderr": err.getvalue(),
+        }
+        if status == 0:
+            self.extractions[key] = (args, inputs, self.outputs(args), response)
+        else:
+            self.extractions.pop(key, None)
+        return response
+
+    def outputs(self, args):
+        return file_stat(args.apn_out), file_stat(args.cc_out)
+
+    def watch(self):
+        """Extract served requests again whenever their inputs change."""
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                for key, (args, inputs, _, _) in list(self.extractions.items()):
+                    cwd, argv = key
+                    try:
+                        with working_directory(cwd):
+                            if extraction_inputs(args) == inputs:
+                                continue
+                            print(
+                                f"Inputs of {shlex.join(argv)} changed, extracting",
+                                file=sys.stderr,
+                            )
+                            self.extract(key, argv)
+                    except OSError:
+                        # The directory it was run from is gone
+                        del self.extractions[key]
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def request_extraction(socket_path, argv):
+    """Have the ExtractionServer listening on socket_path run the extraction
+    of a command line, printing its output.
+
+    Returns the exit status of the extraction, or None if there is no server to
+    run it.
+    """
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    request = json.dumps({"cwd": os.getcwd(), "argv": argv}).encode() + b"\n"
+    with socket.socket(socket.AF_UNIX) as client:
+        try:
+            client.connect(socket_path)
+            client.sendall(request)
+            with client.makefile("rb") as f:
+                response = f.readline()
+        except OSError:
+            return None
+    if not response:
+        # The server went away
+        return None
+    response = json.loads(response)
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["status"]
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    description = "Convert Pixel CarrierSettings protobufs to AOSP XMLs"
+    jobs_help = "number of parallel jobs (default: 1)"
+    config_rules_help = "file of unwanted config rules (default: unwanted_configs.txt)"
+    filter_report_help = (
+        "print how many configs each rule dropped, rendered configs only"
+    )
+    compact_help = (
+        "leave out configs which do not change what any SIM loads, and report the"
+        " size reduction"
+    )
+    verify_help = (
+        "read the generated XMLs back and check them against the inputs and what"
+        " TelephonyProvider and the CarrierConfig app accept"
+    )
+    cache_dir_help = (
+        "directory caching rendered output between runs, so only carriers whose"
+        " inputs changed are rendered again"
+    )
+    if argv[:1] == ["diff"]:
+        parser = argparse.ArgumentParser(
+            prog="carriersettings_extractor diff",
+            description="Compare two CarrierSettings drops carrier by carrier",
+        )
+        input_help = "CarrierSettings directory, archive or snapshot"
+        parser.add_argument("old", help=input_help)
+        parser.add_argument("new", help=input_help)
+        parser.add_argument("--json", action="store_true", help="write JSON")
+        parser.add_argument("-o", "--output", help="write the report to this file")
+        args = parser.parse_args(argv[1:])
+        report = diff_settings(args.old, args.new)
+        if args.output:
+            output = open(args.output, "w", encoding="utf-8")
+        else:
+            output = nullcontext(sys.stdout)
+        with output as f:
+            if args.json:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+                f.write("\n")
+            else:
+                print_diff(report, f)
+        # Like diff(1), exit with 1 if there are differences
+        sys.exit(1 if report["added"] or report["removed"] or report["changed"] else 0)
+    if argv[:1] == ["query"]:
+        parser = argparse.ArgumentParser(
+            prog="carriersettings_extractor query",
+            description="Show the apns and configs shipped for matching carriers",
+        )
+        parser.add_argument(
+            "pb_path", help="CarrierSettings directory, archive or snapshot"
+        )
+        parser.add_argument("android_build_top", help="root of the AOSP tree")
+        parser.add_argument("device", help="device codename")
+        parser.add_argument("--mccmnc", help="MCC and MNC of the SIM")
+        parser.add_argument("--spn", help="service provider name of the SIM")
+        parser.add_argument("--imsi", help="IMSI of the SIM")
+        parser.add_argument("--gid1", help="group identifier level 1 of the SIM")
+        parser.add_argument("--name", help="canonical name, instead of a SIM")
+        parser.add_argument("--config-rules", help=config_rules_help)
+        parser.add_argument("--json", action="store_true", help="write JSON")
+        args = parser.parse_args(argv[1:])
+        if (args.mccmnc is None) == (args.name is None):
+            parser.error("exactly one of --mccmnc and --name is required")
+        carrier_list, all_settings, _ = load_settings_lazily(args.pb_path)
+        # Keep the warnings of gen_config_tree out of the output
+        with redirect_stdout(sys.stderr):
+            result = query(
+                carrier_list,
+                all_settings,
+                load_carrier_ids(args.android_build_top),
+                compile_config_filter(args.device, args.config_rules),
+                args.mccmnc,
+                args.spn,
+                args.imsi,
+                args.gid1,
+                args.name,
+            )
+        if args.json:
+            json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+            print()
+        else:
+            print_query(result)
+        return
+    if argv[:1] == ["batch"]:
+        parser = argparse.ArgumentParser(
+            prog="carriersettings_extractor batch", description=description
+        )
+        parser.add_argument("manifest", help="file listing the devices to extract")
+        parser.add_argument("android_build_top", help="root of the AOSP tree")
+        parser.add_argument("-j", "--jobs", type=int, default=1, help=jobs_help)
+        parser.add_argument("--cache-dir", help=cache_dir_help)
+        parser.add_argument("--config-rules", help=config_rules_help)
+        parser.add_argument(
+            "--filter-report", action="store_true", help=filter_report_help
+        )
+        parser.add_argument(
+            "--snapshot-dir",
+            help="directory keeping a snapshot of the inputs of each extraction",
+        )
+        parser.add_argument("--compact", action="store_true", help=compact_help)
+        parser.add_argument("--verify", action="store_true", help=verify_help)
+        add_instrumentation_arguments(parser)
+        args = parser.parse_args(argv[1:])
+        config_filters = instrumented(
+            args,
+            lambda: batch(
+                args.manifest,
+                args.android_build_top,
+                args.jobs,
+                args.cache_dir,
+                args.config_rules,
+                args.snapshot_dir,
+                args.compact,
+                args.verify,
+            ),
+        )
+        if args.filter_report:
+            print_filter_report(config_filters)
+        if args.compact:
+            print_compaction_report()
+        return
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "pb_path",
+        help="CarrierSettings directory, or zip or tar archive containing it,"
+        " optionally followed by !<path in the archive>",
+    )
+    parser.add_argument("android_build_top", help="root of the AOSP tree")
+    parser.add_argument("apn_out", help="output path of apns-conf.xml")
+    parser.add_argument("cc_out", help="output path of carrierconfig-vendor.xml")
+    parser.add_argument("device", help="device codename")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes rendering carrierconfig-vendor.xml (default: 1)",
+    )
+    parser.add_argument("--cache-dir", help=cache_dir_help)
+    parser.add_argument("--config-rules", help=config_rules_help)
+    parser.add_argument("--filter-report", action="store_true", help=filter_report_help)
+    parser.add_argument(
+        "--snapshot",
+        metavar="FILE",
+        help="read the resolved inputs from this snapshot, (re)writing it when"
+        " they changed",
+    )
+    parser.add_argument("--compact", action="store_true", help=compact_help)
+    parser.add_argument("--verify", action="store_true", help=verify_help)
+    parser.add_argument(
+        "--server",
+        metavar="SOCKET",
+        help="have the server listening on this socket extract, extracting"
+        " locally if there is none",
+    )
+    add_instrumentation_arguments(parser)
+    if argv[:1] == ["serve"]:
+        serve_parser = argparse.ArgumentParser(
+            prog="carriersettings_extractor serve",
+            description="Serve extractions from a process keeping its inputs loaded,"
+            " re-rendering outputs when their inputs change",
+        )
+        serve_parser.add_argument("socket", help="path of the Unix socket")
+        serve_parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="seconds between checks of the inputs of served extractions"
+            " (default: 1)",
+        )
+        serve_args = serve_parser.parse_args(argv[1:])
+        ExtractionServer(serve_args.socket, parser, serve_args.interval).run()
+        return
+    args = parser.parse_args(argv)
+    if args.server is not None:
+        status = request_extraction(args.server, argv)
+        if status is not None:
+            sys.exit(status)
+    run_extraction(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""Regression tests of carriersettings_extractor.
+
+The tests which need the protobuf modules generated from the .proto files are
+skipped when those are not importable.
+"""
+
+import contextlib
+import importlib.util
+import io
+import os.path
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import carriersettings_extractor as cse
+
+has_protos = importlib.util.find_spec("carrier_settings_pb2") is not None
+
+
+def limit_open_files(limit):
+    """Lower the soft limit of open files to at most limit, returning a function
+    restoring it."""
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(soft, limit), hard))
+    return lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class CarrierIdMatcherTest(unittest.TestCase):
+    """match() must resolve SIMs like CarrierResolver."""
+
+    def setUp(self):
+        from carrierId_pb2 import CarrierList as CarrierIdList
+
+        carrier_id_list = CarrierIdList()
+        for canonical_id, fields in [
+            (1, {"spn": ["Foo"]}),
+            (2, {"spn": ["FOO"]}),
+            (3, {"gid1": ["BA"]}),
+            (4, {"imsi_prefix_xpattern": ["310260x1"]}),
+            (5, {"gid1": ["BA01"], "gid2": ["FF"]}),
+            (6, {}),
+        ]:
+            carrier_id_obj = carrier_id_list.carrier_id.add()
+            carrier_id_obj.canonical_id = canonical_id
+            carrier_attribute = carrier_id_obj.carrier_attribute.add()
+            carrier_attribute.mccmnc_tuple.append("310260")
+            for field, values in fields.items():
+                getattr(carrier_attribute, field).extend(values)
+        self.matcher = cse.CarrierIdMatcher(carrier_id_list)
+
+    def test_match(self):
+        match = self.matcher.match
+        self.assertEqual(match("310260"), 6)
+        self.assertEqual(match("310410"), None)
+        # Ties keep the first attribute
+        self.assertEqual(match("310260", spn="foo"), 1)
+        # A GID1 outweighs an SPN, an IMSI prefix both
+        self.assertEqual(match("310260", spn="foo", gid1="ba01"), 3)
+        self.assertEqual(
+            match("310260", imsi="310260912345", spn="foo", gid1="ba01"), 4
+        )
+        self.assertEqual(match("310260", imsi="310260922345", gid1="BA01"), 3)
+
+
+def aggregate_by_insert(carrier_list):
+    """Group carrier_list entries like aggregate_carrier_configs() did before it
+    kept the entries without MVNO data apart, inserting each at the start."""
+    aggregated = {}
+    for index, entry in enumerate(carrier_list.entry):
+        carrier_id = entry.carrier_id[0]
+        tail = "\n" if index == len(carrier_list.entry) - 1 else "\n    "
+        group = aggregated.setdefault(
+            "carrier_config_mccmnc_" + carrier_id.mcc_mnc + ".xml", []
+        )
+        if not any(carrier_id.HasField(i) for i in ["gid1", "spn", "imsi"]):
+            group.insert(0, (entry, tail))
+        else:
+            group.append((entry, tail))
+    return aggregated
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class AggregateCarrierConfigsTest(unittest.TestCase):
+    """aggregate_carrier_configs() must keep the order of the former
+    implementation."""
+
+    def test_random_carrier_lists(self):
+        from carrier_list_pb2 import CarrierList
+
+        def names(aggregated):
+            return [
+                (mccmnc_combo, [(entry.canonical_name, tail) for entry, tail in group])
+                for mccmnc_combo, group in aggregated.items()
+            ]
+
+        for seed in range(50):
+            rnd = random.Random(seed)
+            carrier_list = CarrierList()
+            for i in range(rnd.randrange(1, 60)):
+                entry = carrier_list.entry.add()
+                entry.canonical_name = f"carrier{i}"
+                carrier_id = entry.carrier_id.add()
+                carrier_id.mcc_mnc = rnd.choice(["000000", "310260", "310410", "23410"])
+                # MVNO fields, possibly set to an empty string
+                for field in rnd.sample(["spn", "gid1", "imsi"], rnd.randrange(4)):
+                    setattr(carrier_id, field, rnd.choice(["", "A", "3102601x"]))
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    names(cse.aggregate_carrier_configs(carrier_list)),
+                    names(aggregate_by_insert(carrier_list)),
+                )
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class QueryTest(unittest.TestCase):
+    """query() must merge every carrier_config element the CarrierConfig app
+    applies to a SIM, in file order."""
+
+    def test_global_and_mvno_elements(self):
+        from carrier_list_pb2 import CarrierList
+        from carrier_settings_pb2 import CarrierSettings
+        from carrierId_pb2 import CarrierList as CarrierIdList
+
+        carrier_list = CarrierList()
+        all_settings = {}
+        for canonical_name, carrier_id_fields, configs in [
+            ("global", {"mcc_mnc": "000000"}, {"a": 1, "b": 1}),
+            ("carrier", {"mcc_mnc": "310260"}, {"a": 2}),
+            ("gid1_mvno", {"mcc_mnc": "000000", "gid1": "BA01"}, {"b": 3, "c": 3}),
+            ("imsi_mvno", {"mcc_mnc": "310260", "imsi": "3102601[0-9]5.*"}, {"a": 4}),
+            ("other_spn_mvno", {"mcc_mnc": "310410", "spn": "foo.*"}, {"a": 5}),
+            ("spn_mvno", {"mcc_mnc": "000000", "spn": "FOO"}, {"d": 6}),
+        ]:
+            entry = carrier_list.entry.add()
+            entry.canonical_name = canonical_name
+            carrier_id = entry.carrier_id.add()
+            for field, value in carrier_id_fields.items():
+                setattr(carrier_id, field, value)
+            setting = all_settings[canonical_name] = CarrierSettings()
+            for key, value in configs.items():
+                config = setting.configs.config.add()
+                config.key = f"config_{key}"
+                config.int_value = value
+
+        result = cse.query(
+            carrier_list,
+            all_settings,
+            cse.CarrierIdMatcher(CarrierIdList()),
+            cse.compile_config_filter("oriole"),
+            mcc_mnc="310260",
+            imsi="310260125000",
+            gid1="ba01",
+            spn="Foo Mobile",
+        )
+        self.assertEqual(
+            [carrier["canonical_name"] for carrier in result["carriers"]],
+            ["global", "gid1_mvno", "carrier", "imsi_mvno"],
+        )
+        self.assertEqual(
+            result["merged_configs"],
+            {
+                "config_a": '<int name="config_a" value="4" />',
+                "config_b": '<int name="config_b" value="3" />',
+                "config_c": '<int name="config_c" value="3" />',
+            },
+        )
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class ManyCarrierFilesTest(unittest.TestCase):
+    """Drops of several hundred carrier specific files must not keep a file
+    open per carrier."""
+
+    @classmethod
+    def setUpClass(cls):
+        import carriersettings_benchmark
+
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.corpora = []
+        for seed in range(2):
+            pb_path, android_build_top = carriersettings_benchmark.generate_corpus(
+                os.path.join(cls.directory.name, str(seed)),
+                carriers=600,
+                apns=1,
+                configs=4,
+                carrier_files=1.0,
+                seed=seed,
+            )
+            cls.corpora.append((pb_path, android_build_top))
+        cls.addClassCleanup(cls.directory.cleanup)
+
+    def setUp(self):
+        # Over 1024 files in total, with the usual default limit
+        self.addCleanup(limit_open_files(1024))
+
+    def test_diff(self):
+        (old, _), (new, _) = self.corpora
+        report = cse.diff_settings(old, new)
+        self.assertEqual(len(report["changed"]), 600)
+
+    def test_query(self):
+        pb_path, android_build_top = self.corpora[0]
+        # Fewer than the carrier files of one drop
+        self.addCleanup(limit_open_files(512))
+        carrier_list, all_settings, _ = cse.load_settings_lazily(pb_path)
+        result = cse.query(
+            carrier_list,
+            all_settings,
+            cse.load_carrier_ids(android_build_top),
+            cse.compile_config_filter("oriole"),
+            canonical_name="carrier5",
+        )
+        self.assertEqual(
+            [carrier["canonical_name"] for carrier in result["carriers"]], ["carrier5"]
+        )
+        self.assertEqual(len(result["carriers"][0]["apns"]), 1)
+
+
+class ReadManifestTest(unittest.TestCase):
+    def read(self, text):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write(text)
+            f.flush()
+            return cse.read_manifest(f.name)
+
+    def test_devices(self):
+        self.assertEqual(
+            self.read("# comment\n\na/ a.xml b.xml oriole\nb/ c.xml d.xml raven\n"),
+            [("a/", "a.xml", "b.xml", "oriole"), ("b/", "c.xml", "d.xml", "raven")],
+        )
+
+    def test_duplicate_device(self):
+        with self.assertRaisesRegex(ValueError, ":2: oriole already listed on line 1"):
+            self.read("a/ a.xml b.xml oriole\nb/ c.xml d.xml oriole\n")
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class RepeatedExtractionTest(unittest.TestCase):
+    """Extractions repeated in one process, like those of a server, must match
+    those of fresh processes."""
+
+    def setUp(self):
+        import carriersettings_benchmark
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.pb_path, android_build_top = carriersettings_benchmark.generate_corpus(
+            self.directory, carriers=50, configs=10
+        )
+        self.carrier_id_matcher = cse.load_carrier_ids(android_build_top)
+        self.rules = os.path.join(self.directory, "rules.txt")
+        with open(self.rules, "w", encoding="utf-8") as f:
+            f.write("config_1_*\n")
+
+    def extract(self):
+        outputs = [
+            (
+                os.path.join(self.directory, "apns-conf.xml"),
+                os.path.join(self.directory, "carrierconfig-vendor.xml"),
+                "oriole",
+            )
+        ]
+        config_filters = cse.extract(
+            self.pb_path, self.carrier_id_matcher, outputs, config_rules=self.rules
+        )
+        with open(outputs[0][1], encoding="utf-8") as f:
+            return config_filters["oriole"], f.read()
+
+    def test_filter_counts(self):
+        first, _ = self.extract()
+        first_counts = dict(first.counts)
+        self.assertTrue(first_counts)
+        second, _ = self.extract()
+        self.assertEqual(dict(second.counts), first_counts)
+
+    def test_overrides_reported(self):
+        from carrier_settings_pb2 import CarrierSettings
+
+        with open(os.path.join(self.pb_path, "override.pb"), "wb") as f:
+            f.write(CarrierSettings(canonical_name="carrier0").SerializeToString())
+        reports = []
+        for _ in range(2):
+            counts = cse.stats.counts.copy()
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.extract()
+            counts = cse.stats.counts - counts
+            reports.append(
+                (
+                    stderr.getvalue(),
+                    counts["generic_settings"],
+                    counts["overridden_settings"],
+                )
+            )
+        self.assertIn("Overriding generic settings for carrier0", reports[0][0])
+        self.assertEqual(reports[1], reports[0])
+
+    def test_rules_file_edited(self):
+        _, before = self.extract()
+        self.assertNotIn('name="config_1_', before)
+        with open(self.rules, "w", encoding="utf-8") as f:
+            f.write("config_2_*\n")
+        _, after = self.extract()
+        self.assertIn('name="config_1_', after)
+        self.assertNotIn('name="config_2_', after)
+
+    def test_others_overwritten_in_place(self):
+        with mock.patch.object(cse, "_keep_mappings", False):
+            _, all_settings = cse.load_settings(self.pb_path)
+        # Truncating a file which is still mapped makes reading it fault
+        with open(os.path.join(self.pb_path, "others.pb"), "r+b") as f:
+            f.truncate()
+        names = [all_settings[name].canonical_name for name in all_settings]
+        self.assertEqual(names, list(all_settings))
+
+
+@unittest.skipUnless(has_protos, "protobuf modules not generated")
+class SnapshotTest(unittest.TestCase):
+    """Snapshots of inputs whose contents are unchanged must be reused."""
+
+    def setUp(self):
+        import carriersettings_benchmark
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        (
+            self.pb_path,
+            self.android_build_top,
+        ) = carriersettings_benchmark.generate_corpus(directory.name, carriers=20)
+        self.filename = os.path.join(directory.name, "snapshot")
+        self.carrier_list = cse.load_snapshot(
+            self.filename, self.pb_path, cse.load_carrier_ids(self.android_build_top)
+        ).carrier_list
+
+    def test_carrier_ids_not_parsed(self):
+        cse._loaded.clear()
+        calls = cse.stats.stages.get("load_carrier_ids", {}).get("calls", 0)
+        snapshot = cse.load_snapshot(
+            self.filename, self.pb_path, cse.load_carrier_ids(self.android_build_top)
+        )
+        self.assertEqual(snapshot.carrier_list, self.carrier_list)
+        self.assertEqual(cse.stats.stages["load_carrier_ids"]["calls"], calls)
+
+    def test_touched_inputs(self):
+        carrier_id_matcher = cse.load_carrier_ids(self.android_build_top)
+        for name in os.listdir(self.pb_path):
+            path = os.path.join(self.pb_path, name)
+            mtime = os.stat(path).st_mtime
+            os.utime(path, (mtime + 10, mtime + 10))
+
+        with mock.patch.object(
+            cse, "settings_digest", wraps=cse.settings_digest
+        ) as settings_digest:
+            for _ in range(2):
+                snapshot = cse.load_snapshot(
+                    self.filename, self.pb_path, carrier_id_matcher
+                )
+                self.assertEqual(snapshot.carrier_list, self.carrier_list)
+        # Hashed once to find the contents unchanged, not on every run
+        self.assertEqual(settings_digest.call_count, 1)